@@ -0,0 +1,218 @@
+use gstreamer as gst;
+use std::ptr::NonNull;
+use std::sync::Arc;
+
+pub const BLOCK_SIZE: usize = 1024 * 1024;
+
+// Fixed-size chunk of arena memory. Stored buffers reference ranges of it;
+// once only the arena holds it again the whole block is free for reuse.
+struct Block {
+    ptr: NonNull<u8>,
+    len: usize,
+}
+
+// SAFETY: the block owns its allocation; concurrent access only ever reads
+// ranges that are no longer written to
+unsafe impl Send for Block {}
+unsafe impl Sync for Block {}
+
+impl Block {
+    fn new(len: usize) -> Self {
+        let data = vec![0u8; len].into_boxed_slice();
+        let ptr = NonNull::new(Box::into_raw(data) as *mut u8).unwrap();
+        Self { ptr, len }
+    }
+}
+
+impl Drop for Block {
+    fn drop(&mut self) {
+        // SAFETY: allocated in `Block::new()` with this length
+        unsafe {
+            drop(Box::from_raw(std::ptr::slice_from_raw_parts_mut(self.ptr.as_ptr(), self.len)));
+        }
+    }
+}
+
+struct ArenaSlice {
+    block: Arc<Block>,
+    offset: usize,
+    len: usize,
+}
+
+impl AsRef<[u8]> for ArenaSlice {
+    fn as_ref(&self) -> &[u8] {
+        // SAFETY: the range was fully written before the slice was created
+        // and is not written again while the block is referenced
+        unsafe { std::slice::from_raw_parts(self.block.ptr.as_ptr().add(self.offset), self.len) }
+    }
+}
+
+// Private arena that stored payloads are copied into, so that upstream
+// buffers (and their pools) are released as soon as they are stored.
+//
+// Payloads are packed back to back, small GOPs sharing a block. The history
+// is evicted in stream order, so blocks free up in the order they were
+// filled; a block only stays referenced while the newest GOP in it is kept,
+// which bounds the overhead to about one block.
+pub struct Arena {
+    blocks: Vec<Arc<Block>>,
+    // Index into `blocks` and fill level of the block being written
+    current: Option<(usize, usize)>,
+}
+
+impl Arena {
+    // Preallocate `size` bytes worth of blocks
+    pub fn new(size: u64) -> Self {
+        let count = (size as usize).div_ceil(BLOCK_SIZE).max(1);
+        Self {
+            blocks: (0..count).map(|_| Arc::new(Block::new(BLOCK_SIZE))).collect(),
+            current: None,
+        }
+    }
+
+    // Find a block no stored buffer references anymore. `Arc::get_mut()`
+    // synchronizes with the release of the last other reference, so reads
+    // of the block by downstream threads happen before it is written again.
+    fn free_block(&mut self) -> Option<usize> {
+        let current = self.current.map(|(idx, _)| idx);
+        self.blocks
+            .iter_mut()
+            .enumerate()
+            .position(|(idx, block)| Some(idx) != current && Arc::get_mut(block).is_some())
+    }
+
+    // Copy `buffer` into the arena. Falls back to a plain deep copy if the
+    // payload does not fit in a block or the arena is exhausted.
+    pub fn copy(&mut self, buffer: &gst::Buffer) -> gst::Buffer {
+        let deep_copy = || buffer.copy_deep().unwrap_or_else(|_| buffer.clone());
+        let map = match buffer.map_readable() {
+            Ok(map) => map,
+            Err(_) => return buffer.clone(),
+        };
+        let size = map.len();
+        // Too large for any block: keep the current one going for the
+        // buffers that follow
+        if size > BLOCK_SIZE {
+            return deep_copy();
+        }
+
+        let fits = self.current.is_some_and(|(_, fill)| fill + size <= BLOCK_SIZE);
+        if !fits {
+            self.current = self.free_block().map(|idx| (idx, 0));
+        }
+        let (idx, offset) = match self.current {
+            Some(current) => current,
+            _ => return deep_copy(),
+        };
+
+        // Everything but the payload, metas (video, timecode...) included
+        let mut copy = gst::Buffer::new();
+        let flags = gst::BufferCopyFlags::FLAGS
+            | gst::BufferCopyFlags::TIMESTAMPS
+            | gst::BufferCopyFlags::META;
+        if buffer.copy_into(copy.get_mut().unwrap(), flags, ..).is_err() {
+            return deep_copy();
+        }
+
+        let block = self.blocks[idx].clone();
+        // SAFETY: `offset..offset + size` is inside the block and past
+        // everything handed out from it so far
+        unsafe {
+            std::ptr::copy_nonoverlapping(map.as_ptr(), block.ptr.as_ptr().add(offset), size);
+        }
+        self.current = Some((idx, offset + size));
+
+        copy.get_mut().unwrap().append_memory(gst::Memory::from_slice(ArenaSlice {
+            block,
+            offset,
+            len: size,
+        }));
+        copy
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn buffer(size: usize, fill: u8) -> gst::Buffer {
+        gst::init().unwrap();
+        gst::Buffer::from_mut_slice(vec![fill; size])
+    }
+
+    fn data_ptr(buffer: &gst::Buffer) -> *const u8 {
+        buffer.peek_memory(0).map_readable().unwrap().as_ptr()
+    }
+
+    fn assert_filled(buffer: &gst::Buffer, size: usize, fill: u8) {
+        let map = buffer.map_readable().unwrap();
+        assert_eq!(map.len(), size);
+        assert!(map.iter().all(|b| *b == fill));
+    }
+
+    #[test]
+    fn payloads_are_packed_back_to_back() {
+        let mut arena = Arena::new(0);
+        let first = arena.copy(&buffer(100, 1));
+        let second = arena.copy(&buffer(50, 2));
+        assert_filled(&first, 100, 1);
+        assert_filled(&second, 50, 2);
+        assert_eq!(data_ptr(&second), data_ptr(&first).wrapping_add(100));
+    }
+
+    #[test]
+    fn oversized_payloads_keep_the_current_block() {
+        let mut arena = Arena::new(0);
+        let first = arena.copy(&buffer(100, 1));
+        let large = arena.copy(&buffer(BLOCK_SIZE + 1, 2));
+        assert_filled(&large, BLOCK_SIZE + 1, 2);
+
+        let next = arena.copy(&buffer(10, 3));
+        assert_eq!(data_ptr(&next), data_ptr(&first).wrapping_add(100));
+    }
+
+    #[test]
+    fn blocks_are_reused_once_released() {
+        let mut arena = Arena::new(0);
+        let first = arena.copy(&buffer(BLOCK_SIZE - 10, 1));
+        let start = data_ptr(&first);
+
+        // The only block is still referenced: plain copy
+        let fallback = arena.copy(&buffer(20, 2));
+        assert_filled(&fallback, 20, 2);
+        let end = start.wrapping_add(BLOCK_SIZE);
+        assert!(data_ptr(&fallback) < start || data_ptr(&fallback) >= end);
+
+        drop(first);
+        let reused = arena.copy(&buffer(20, 3));
+        assert_filled(&reused, 20, 3);
+        assert_eq!(data_ptr(&reused), start);
+    }
+
+    #[test]
+    fn timestamps_flags_and_metas_are_copied() {
+        let mut original = buffer(10, 1);
+        {
+            let original = original.get_mut().unwrap();
+            original.set_pts(gst::ClockTime::from_seconds(1));
+            original.set_dts(gst::ClockTime::from_mseconds(900));
+            original.set_duration(gst::ClockTime::from_mseconds(40));
+            original.set_flags(gst::BufferFlags::DELTA_UNIT);
+            gst::ReferenceTimestampMeta::add(
+                original,
+                &gst::Caps::new_empty_simple("timestamp/x-test"),
+                gst::ClockTime::from_seconds(5),
+                gst::ClockTime::NONE,
+            );
+        }
+
+        let copy = Arena::new(0).copy(&original);
+        assert_filled(&copy, 10, 1);
+        assert_eq!(copy.pts(), original.pts());
+        assert_eq!(copy.dts(), original.dts());
+        assert_eq!(copy.duration(), original.duration());
+        assert!(copy.flags().contains(gst::BufferFlags::DELTA_UNIT));
+        let meta = copy.meta::<gst::ReferenceTimestampMeta>().unwrap();
+        assert_eq!(meta.timestamp(), gst::ClockTime::from_seconds(5));
+    }
+}
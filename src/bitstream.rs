@@ -0,0 +1,429 @@
+use gstreamer as gst;
+
+// Byte-stream buffers are only searched for start codes within this many
+// leading bytes. Length-prefixed NALs and OBUs are skipped by size, so only
+// their headers are read.
+const SCAN_LIMIT: usize = 4096;
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum NalFraming {
+    // Annex B start codes
+    ByteStream,
+    // Big endian length prefixes of this many bytes (avc, hvc1...)
+    Length(usize),
+}
+
+// Codec of the stream, as far as keyframe detection is concerned
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Codec {
+    H264(NalFraming),
+    H265(NalFraming),
+    Vp8,
+    Vp9,
+    Av1,
+}
+
+// What the start of a buffer says about the frame it carries
+#[derive(Debug, Clone, Copy, Default)]
+pub struct FrameInfo {
+    // IDR / IRAP / key frame
+    pub is_keyframe: bool,
+    // In-band SPS/PPS/VPS or AV1 sequence header in front of the frame
+    pub has_parameter_sets: bool,
+}
+
+enum NalKind {
+    Slice { is_keyframe: bool },
+    ParameterSet,
+    Other,
+}
+
+impl Codec {
+    pub fn from_caps(caps: &gst::CapsRef) -> Option<Self> {
+        let s = caps.structure(0)?;
+        // Byte position of the NAL length size in the codec_data record
+        let framing = |size_offset: usize| {
+            let codec_data = s.get::<gst::Buffer>("codec_data").ok();
+            match (s.get::<&str>("stream-format").ok(), codec_data) {
+                (Some("byte-stream"), _) | (_, None) => Some(NalFraming::ByteStream),
+                (_, Some(codec_data)) => {
+                    let map = codec_data.map_readable().ok()?;
+                    let size = *map.get(size_offset)? & 0x3;
+                    Some(NalFraming::Length(size as usize + 1))
+                }
+            }
+        };
+
+        match s.name().as_str() {
+            "video/x-h264" => framing(4).map(Codec::H264),
+            "video/x-h265" => framing(21).map(Codec::H265),
+            "video/x-vp8" => Some(Codec::Vp8),
+            "video/x-vp9" => Some(Codec::Vp9),
+            "video/x-av1" => match s.get::<&str>("stream-format").ok() {
+                None | Some("obu-stream") => Some(Codec::Av1),
+                _ => None,
+            },
+            _ => None,
+        }
+    }
+
+    // Parse the headers at the start of the buffer. Only the first memory
+    // is mapped, so this never merges or copies the payload.
+    // Returns None if the frame could not be identified.
+    pub fn inspect(&self, buffer: &gst::BufferRef) -> Option<FrameInfo> {
+        if buffer.n_memory() == 0 {
+            return None;
+        }
+        let map = buffer.peek_memory(0).map_readable().ok()?;
+        let data = map.as_slice();
+
+        match *self {
+            Codec::H264(framing) => inspect_nals(data, framing, h264_nal_kind),
+            Codec::H265(framing) => inspect_nals(data, framing, h265_nal_kind),
+            Codec::Vp8 => inspect_vp8(data),
+            Codec::Vp9 => inspect_vp9(data),
+            Codec::Av1 => inspect_av1(data),
+        }
+    }
+
+    // Copy the in-band parameter set NAL units in front of the first slice,
+    // in the stream's own framing. H.264 and H.265 only; the other codecs
+    // carry everything a decoder needs in their keyframes.
+    pub fn parameter_sets(&self, buffer: &gst::BufferRef) -> Option<Vec<u8>> {
+        let (framing, classify): (_, fn(&[u8]) -> NalKind) = match *self {
+            Codec::H264(framing) => (framing, h264_nal_kind),
+            Codec::H265(framing) => (framing, h265_nal_kind),
+            _ => return None,
+        };
+        if buffer.n_memory() == 0 {
+            return None;
+        }
+        let map = buffer.peek_memory(0).map_readable().ok()?;
+
+        let mut sets = Vec::new();
+        for nal in Nals::new(map.as_slice(), framing) {
+            match classify(nal) {
+                NalKind::Slice { .. } => break,
+                NalKind::ParameterSet => {
+                    match framing {
+                        NalFraming::ByteStream => sets.extend_from_slice(&[0, 0, 0, 1]),
+                        NalFraming::Length(size) => {
+                            sets.extend_from_slice(&(nal.len() as u32).to_be_bytes()[4 - size..])
+                        }
+                    }
+                    sets.extend_from_slice(nal);
+                }
+                NalKind::Other => {}
+            }
+        }
+        (!sets.is_empty()).then_some(sets)
+    }
+
+    // Length of the access unit delimiter starting the buffer, framing
+    // included, if there is one. It has to stay the first NAL unit of the
+    // access unit, so anything inserted goes after it.
+    pub fn leading_aud_len(&self, buffer: &gst::BufferRef) -> Option<usize> {
+        let (framing, is_aud): (_, fn(&[u8]) -> bool) = match *self {
+            Codec::H264(framing) => (framing, |nal| nal[0] & 0x1f == 9),
+            Codec::H265(framing) => (framing, |nal| (nal[0] >> 1) & 0x3f == 35),
+            _ => return None,
+        };
+        if buffer.n_memory() == 0 {
+            return None;
+        }
+        let map = buffer.peek_memory(0).map_readable().ok()?;
+
+        let mut nals = Nals::new(map.as_slice(), framing);
+        let nal = nals.next()?;
+        (is_aud(nal) && nals.pos < map.len()).then_some(nals.pos)
+    }
+}
+
+fn h264_nal_kind(nal: &[u8]) -> NalKind {
+    match nal[0] & 0x1f {
+        kind @ 1..=5 => NalKind::Slice { is_keyframe: kind == 5 },
+        7 | 8 => NalKind::ParameterSet,
+        _ => NalKind::Other,
+    }
+}
+
+fn h265_nal_kind(nal: &[u8]) -> NalKind {
+    match (nal[0] >> 1) & 0x3f {
+        kind @ 0..=31 => NalKind::Slice { is_keyframe: (16..=23).contains(&kind) },
+        32..=34 => NalKind::ParameterSet,
+        _ => NalKind::Other,
+    }
+}
+
+// Iterates over the NAL units of a buffer, each slice starting at the NAL
+// header. A NAL unit extending past the mapped data (or, in byte-stream
+// format, past the scanned window) runs to the end of the data.
+struct Nals<'a> {
+    data: &'a [u8],
+    pos: usize,
+    framing: NalFraming,
+}
+
+impl<'a> Nals<'a> {
+    fn new(data: &'a [u8], framing: NalFraming) -> Self {
+        Self { data, pos: 0, framing }
+    }
+}
+
+impl<'a> Iterator for Nals<'a> {
+    type Item = &'a [u8];
+
+    fn next(&mut self) -> Option<&'a [u8]> {
+        let (start, end) = match self.framing {
+            NalFraming::Length(size) => {
+                let prefix = self.data.get(self.pos..self.pos + size)?;
+                let len = prefix.iter().fold(0usize, |len, &b| (len << 8) | b as usize);
+                let start = self.pos + size;
+                self.pos = start.checked_add(len)?;
+                (start, self.pos.min(self.data.len()))
+            }
+            NalFraming::ByteStream => {
+                let window = &self.data[..self.data.len().min(SCAN_LIMIT)];
+                let start = find_start_code(window, self.pos)?;
+                let end = match find_start_code(window, start) {
+                    // Trailing zeros belong to the next (4 byte) start code
+                    Some(next) => {
+                        let mut end = next - 3;
+                        while end > start && self.data[end - 1] == 0 {
+                            end -= 1;
+                        }
+                        end
+                    }
+                    None => self.data.len(),
+                };
+                self.pos = end;
+                (start, end)
+            }
+        };
+        self.data.get(start..end).filter(|nal| !nal.is_empty())
+    }
+}
+
+// Position right after the next 00 00 01 start code at or after `from`
+fn find_start_code(data: &[u8], from: usize) -> Option<usize> {
+    let mut i = from;
+    while i + 3 <= data.len() {
+        if data[i + 2] > 1 {
+            // No start code can begin at i, i + 1 or i + 2
+            i += 3;
+        } else if data[i] == 0 && data[i + 1] == 0 && data[i + 2] == 1 {
+            return Some(i + 3);
+        } else {
+            i += 1;
+        }
+    }
+    None
+}
+
+// Walk the NAL units up to the first slice, which decides the frame type
+fn inspect_nals(
+    data: &[u8],
+    framing: NalFraming,
+    classify: fn(&[u8]) -> NalKind,
+) -> Option<FrameInfo> {
+    let mut info = FrameInfo::default();
+    for nal in Nals::new(data, framing) {
+        match classify(nal) {
+            NalKind::Slice { is_keyframe } => {
+                info.is_keyframe = is_keyframe;
+                return Some(info);
+            }
+            NalKind::ParameterSet => info.has_parameter_sets = true,
+            NalKind::Other => {}
+        }
+    }
+    None
+}
+
+// Frame tag: the lowest bit of the first byte is 0 for key frames
+fn inspect_vp8(data: &[u8]) -> Option<FrameInfo> {
+    let tag = *data.first()?;
+    Some(FrameInfo {
+        is_keyframe: tag & 0x1 == 0,
+        has_parameter_sets: false,
+    })
+}
+
+// Uncompressed header: frame_marker(2) profile_low(1) profile_high(1)
+// [reserved_zero(1) for profile 3] show_existing_frame(1) frame_type(1)
+fn inspect_vp9(data: &[u8]) -> Option<FrameInfo> {
+    let b = *data.first()?;
+    if b >> 6 != 0b10 {
+        return None;
+    }
+    let profile = ((b >> 5) & 0x1) | (((b >> 4) & 0x1) << 1);
+    let bit = if profile == 3 { 5 } else { 4 };
+    let show_existing_frame = (b >> (7 - bit)) & 0x1 != 0;
+    let frame_type = (b >> (7 - (bit + 1))) & 0x1;
+    Some(FrameInfo {
+        is_keyframe: !show_existing_frame && frame_type == 0,
+        has_parameter_sets: false,
+    })
+}
+
+fn read_leb128(data: &[u8]) -> Option<(usize, usize)> {
+    let mut value = 0usize;
+    for (i, &b) in data.iter().take(8).enumerate() {
+        value |= ((b & 0x7f) as usize) << (i * 7);
+        if b & 0x80 == 0 {
+            return Some((value, i + 1));
+        }
+    }
+    None
+}
+
+// Walk the OBUs up to the first frame header. Assumes no reduced still
+// picture header, which only still images use.
+fn inspect_av1(data: &[u8]) -> Option<FrameInfo> {
+    let mut info = FrameInfo::default();
+    let mut pos = 0;
+    while let Some(&header) = data.get(pos) {
+        let obu_type = (header >> 3) & 0xf;
+        let has_extension = header & 0x4 != 0;
+        let has_size = header & 0x2 != 0;
+
+        let mut payload = pos + 1 + has_extension as usize;
+        let size = if has_size {
+            let (size, len) = read_leb128(data.get(payload..)?)?;
+            payload += len;
+            Some(size)
+        } else {
+            None
+        };
+
+        match obu_type {
+            // OBU_SEQUENCE_HEADER
+            1 => info.has_parameter_sets = true,
+            // OBU_FRAME_HEADER / OBU_FRAME: show_existing_frame(1) frame_type(2)
+            3 | 6 => {
+                let b = *data.get(payload)?;
+                let show_existing_frame = b & 0x80 != 0;
+                info.is_keyframe = !show_existing_frame && (b >> 5) & 0x3 == 0;
+                return Some(info);
+            }
+            _ => {}
+        }
+
+        // Without a size field the OBU runs to the end of the buffer
+        pos = payload.checked_add(size?)?;
+    }
+    None
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn buffer(data: &[u8]) -> gst::Buffer {
+        gst::init().unwrap();
+        gst::Buffer::from_mut_slice(data.to_vec())
+    }
+
+    fn is_keyframe(codec: Codec, data: &[u8]) -> Option<bool> {
+        codec.inspect(&buffer(data)).map(|info| info.is_keyframe)
+    }
+
+    #[test]
+    fn vp9_frame_type_bit_depends_on_profile() {
+        // frame_marker, profile_low, profile_high, show_existing_frame,
+        // frame_type
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1000_0000]), Some(true));
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1000_0100]), Some(false));
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1000_1000]), Some(false));
+        // Profile 3 has a reserved bit in front of show_existing_frame
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1011_0000]), Some(true));
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1011_0010]), Some(false));
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b1011_0100]), Some(false));
+        // Bad frame marker
+        assert_eq!(is_keyframe(Codec::Vp9, &[0b0100_0000]), None);
+    }
+
+    #[test]
+    fn leb128() {
+        assert_eq!(read_leb128(&[0x05]), Some((5, 1)));
+        assert_eq!(read_leb128(&[0x85, 0x01]), Some((133, 2)));
+        assert_eq!(read_leb128(&[0x80, 0x80, 0x01, 0xff]), Some((1 << 14, 3)));
+        assert_eq!(read_leb128(&[0x80, 0x80]), None);
+    }
+
+    #[test]
+    fn av1_skips_obus_by_leb128_size() {
+        // Temporal delimiter, 130 byte sequence header, then a key frame
+        let mut data = vec![0x12, 0x00, 0x0a, 0x82, 0x01];
+        data.extend_from_slice(&[0xff; 130]);
+        data.extend_from_slice(&[0x32, 0x01, 0x00]);
+        let info = Codec::Av1.inspect(&buffer(&data)).unwrap();
+        assert!(info.is_keyframe);
+        assert!(info.has_parameter_sets);
+
+        // Inter frame (frame_type 1) without a sequence header
+        let info = Codec::Av1.inspect(&buffer(&[0x12, 0x00, 0x32, 0x01, 0x20])).unwrap();
+        assert!(!info.is_keyframe);
+        assert!(!info.has_parameter_sets);
+
+        // Size running past the end of the buffer
+        assert!(Codec::Av1.inspect(&buffer(&[0x0a, 0x10, 0x00])).is_none());
+    }
+
+    #[test]
+    fn byte_stream_nals_drop_trailing_zeros() {
+        let data = [
+            0, 0, 0, 1, 0x09, 0xf0, // AUD, then a 4 byte start code
+            0, 0, 0, 1, 0x67, 0x42, 0, 0, // SPS with trailing zeros
+            0, 0, 1, 0x65, 0x88, 0x00, // IDR slice, runs to the end
+        ];
+        let nals: Vec<&[u8]> = Nals::new(&data, NalFraming::ByteStream).collect();
+        assert_eq!(nals, [&[0x09, 0xf0][..], &[0x67, 0x42], &[0x65, 0x88, 0x00]]);
+
+        let info = Codec::H264(NalFraming::ByteStream).inspect(&buffer(&data)).unwrap();
+        assert!(info.is_keyframe);
+        assert!(info.has_parameter_sets);
+    }
+
+    #[test]
+    fn length_prefixed_nals() {
+        // avcC with 4 byte lengths: SPS, PPS, IDR slice
+        let avc = [
+            0, 0, 0, 2, 0x67, 0x42, 0, 0, 0, 2, 0x68, 0xce, 0, 0, 0, 3, 0x65, 0x88, 0x84,
+        ];
+        let codec = Codec::H264(NalFraming::Length(4));
+        let info = codec.inspect(&buffer(&avc)).unwrap();
+        assert!(info.is_keyframe);
+        assert!(info.has_parameter_sets);
+        assert_eq!(codec.parameter_sets(&buffer(&avc)).unwrap(), avc[..12]);
+
+        // hvcC with 2 byte lengths: VPS, IDR_W_RADL / TRAIL_R
+        let codec = Codec::H265(NalFraming::Length(2));
+        let idr = [0, 3, 0x40, 0x01, 0x0c, 0, 3, 0x26, 0x01, 0xaf];
+        assert_eq!(codec.inspect(&buffer(&idr)).map(|info| info.is_keyframe), Some(true));
+        assert_eq!(codec.parameter_sets(&buffer(&idr)).unwrap(), idr[..5]);
+        let trail = [0, 3, 0x02, 0x01, 0xd0];
+        assert_eq!(codec.inspect(&buffer(&trail)).map(|info| info.is_keyframe), Some(false));
+
+        // A length past the end of the data cuts the NAL short
+        let truncated = [0, 0, 0, 9, 0x65, 0x88];
+        assert_eq!(is_keyframe(Codec::H264(NalFraming::Length(4)), &truncated), Some(true));
+        assert_eq!(is_keyframe(Codec::H264(NalFraming::Length(4)), &truncated[..3]), None);
+    }
+
+    #[test]
+    fn leading_aud() {
+        let codec = Codec::H264(NalFraming::ByteStream);
+        let data = [0, 0, 0, 1, 0x09, 0xf0, 0, 0, 0, 1, 0x65, 0x88];
+        assert_eq!(codec.leading_aud_len(&buffer(&data)), Some(6));
+        assert_eq!(codec.leading_aud_len(&buffer(&data[6..])), None);
+
+        let codec = Codec::H264(NalFraming::Length(4));
+        let data = [0, 0, 0, 2, 0x09, 0xf0, 0, 0, 0, 2, 0x65, 0x88];
+        assert_eq!(codec.leading_aud_len(&buffer(&data)), Some(6));
+
+        let codec = Codec::H265(NalFraming::ByteStream);
+        let data = [0, 0, 1, 0x46, 0x01, 0x50, 0, 0, 1, 0x26, 0x01, 0xaf];
+        assert_eq!(codec.leading_aud_len(&buffer(&data)), Some(6));
+    }
+}
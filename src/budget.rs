@@ -0,0 +1,183 @@
+use once_cell::sync::Lazy;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::{Arc, Mutex, Weak};
+use std::time::{Duration, Instant};
+
+// Minimum time between two rebalances. Instances evict what they were asked
+// to on their next stored buffer, so rebalancing more often than that only
+// recomputes the same shares.
+const REBALANCE_INTERVAL: Duration = Duration::from_millis(100);
+
+// Process-wide memory budget shared by all prerollvalve instances.
+//
+// Instances publish their usage through atomics only. The registry lock is
+// taken when an instance is created, and with `try_lock()` by a rebalance.
+// While over the limit, a rebalance runs at most once per
+// `REBALANCE_INTERVAL`; other buffers only pay for one atomic load and a
+// clock read.
+struct Budget {
+    // 0 = unlimited
+    limit: AtomicU64,
+    total: AtomicU64,
+    // Earliest time of the next rebalance, in ns since `epoch`
+    next_rebalance: AtomicU64,
+    epoch: Instant,
+    slots: Mutex<Vec<Weak<BudgetSlot>>>,
+}
+
+static BUDGET: Lazy<Budget> = Lazy::new(|| Budget {
+    limit: AtomicU64::new(0),
+    total: AtomicU64::new(0),
+    next_rebalance: AtomicU64::new(0),
+    epoch: Instant::now(),
+    slots: Mutex::new(Vec::new()),
+});
+
+// One instance's share of the global budget
+pub struct BudgetSlot {
+    used: AtomicU64,
+    // Bytes the instance was asked to evict by the last rebalance
+    shed: AtomicU64,
+}
+
+pub fn register() -> Arc<BudgetSlot> {
+    let slot = Arc::new(BudgetSlot {
+        used: AtomicU64::new(0),
+        shed: AtomicU64::new(0),
+    });
+    let mut slots = BUDGET.slots.lock().unwrap();
+    slots.retain(|slot| slot.strong_count() > 0);
+    slots.push(Arc::downgrade(&slot));
+    slot
+}
+
+pub fn limit() -> u64 {
+    BUDGET.limit.load(Ordering::Relaxed)
+}
+
+pub fn set_limit(limit: u64) {
+    BUDGET.limit.store(limit, Ordering::Relaxed);
+}
+
+// Bytes held by all instances together
+pub fn total() -> u64 {
+    BUDGET.total.load(Ordering::Relaxed)
+}
+
+// Claim the next rebalance if it is due. Only one caller wins per interval.
+fn rebalance_due() -> bool {
+    let now = BUDGET.epoch.elapsed().as_nanos() as u64;
+    let next = BUDGET.next_rebalance.load(Ordering::Relaxed);
+    now >= next
+        && BUDGET
+            .next_rebalance
+            .compare_exchange(next, now + REBALANCE_INTERVAL.as_nanos() as u64, Ordering::Relaxed, Ordering::Relaxed)
+            .is_ok()
+}
+
+// Spread the excess over the instances furthest above their fair share
+fn rebalance() {
+    if let Ok(slots) = BUDGET.slots.try_lock() {
+        let limit = limit();
+        let mut excess = total().saturating_sub(limit);
+        let live: Vec<Arc<BudgetSlot>> = slots.iter().filter_map(Weak::upgrade).collect();
+        if excess > 0 && !live.is_empty() {
+            let fair = limit / live.len() as u64;
+            let mut over: Vec<(u64, &Arc<BudgetSlot>)> = live
+                .iter()
+                .filter_map(|slot| {
+                    let above = slot.used().saturating_sub(fair);
+                    (above > 0).then_some((above, slot))
+                })
+                .collect();
+            over.sort_unstable_by(|a, b| b.0.cmp(&a.0));
+
+            for (above, slot) in over {
+                if excess == 0 {
+                    break;
+                }
+                let shed = above.min(excess);
+                slot.shed.fetch_max(shed, Ordering::Relaxed);
+                excess -= shed;
+            }
+        }
+    }
+}
+
+impl BudgetSlot {
+    pub fn used(&self) -> u64 {
+        self.used.load(Ordering::Relaxed)
+    }
+
+    // Publish this instance's current usage
+    pub fn set_used(&self, bytes: u64) {
+        let old = self.used.swap(bytes, Ordering::Relaxed);
+        let total = if bytes >= old {
+            BUDGET.total.fetch_add(bytes - old, Ordering::Relaxed) + (bytes - old)
+        } else {
+            BUDGET.total.fetch_sub(old - bytes, Ordering::Relaxed) - (old - bytes)
+        };
+
+        let limit = limit();
+        if limit > 0 && total > limit && rebalance_due() {
+            rebalance();
+        }
+    }
+
+    // Bytes this instance should evict, if any; resets the request
+    pub fn take_shed(&self) -> u64 {
+        self.shed.swap(0, Ordering::Relaxed)
+    }
+}
+
+impl Drop for BudgetSlot {
+    fn drop(&mut self) {
+        BUDGET.total.fetch_sub(*self.used.get_mut(), Ordering::Relaxed);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    // The budget is process-wide, so everything touching it runs in one test
+    #[test]
+    fn excess_is_shed_by_the_largest_user() {
+        let a = register();
+        let b = register();
+        set_limit(1000);
+        BUDGET.next_rebalance.store(0, Ordering::Relaxed);
+
+        a.set_used(900);
+        assert_eq!(total(), 900);
+        assert_eq!(a.take_shed(), 0);
+
+        // 200 over the limit, all of it above `a`'s fair share of 500
+        b.set_used(300);
+        assert_eq!(total(), 1200);
+        assert_eq!(a.take_shed(), 200);
+        assert_eq!(b.take_shed(), 0);
+
+        // Still over, but the next rebalance is not due yet
+        b.set_used(400);
+        assert_eq!(a.take_shed(), 0);
+
+        BUDGET.next_rebalance.store(0, Ordering::Relaxed);
+        b.set_used(400);
+        assert_eq!(a.take_shed(), 300);
+        assert_eq!(b.take_shed(), 0);
+
+        // Under the limit nothing is asked for, even when due
+        BUDGET.next_rebalance.store(0, Ordering::Relaxed);
+        a.set_used(500);
+        assert_eq!(total(), 900);
+        assert_eq!(a.take_shed(), 0);
+
+        // Dropped instances no longer count
+        drop(a);
+        assert_eq!(total(), 400);
+        drop(b);
+        assert_eq!(total(), 0);
+        set_limit(0);
+    }
+}
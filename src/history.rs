@@ -0,0 +1,568 @@
+use gstreamer as gst;
+use std::collections::VecDeque;
+
+#[derive(Clone)]
+pub struct StoredBuffer {
+    pub buffer: gst::Buffer,
+    // Position in the stream, see `History::next_seq()`. Kept when the
+    // buffer moves to the thinned or spilled tier, so stored events can be
+    // placed relative to it.
+    pub seq: u64,
+    pub timestamp: gst::ClockTime,
+    pub is_keyframe: bool,
+}
+
+// One entry per keyframe currently held in the history queue
+#[derive(Debug, Clone, Copy)]
+pub struct GopEntry {
+    // Sequence number of the keyframe that starts this GOP
+    pub seq: u64,
+    pub timestamp: gst::ClockTime,
+    // Sum of the buffer sizes in this GOP, keyframe included
+    pub bytes: usize,
+}
+
+// Rolling buffer history with a side index of GOP boundaries.
+//
+// Every buffer gets a monotonically increasing sequence number, so a GOP
+// entry stays valid while buffers are popped from the front: its position in
+// the queue is simply `seq - head_seq`.
+#[derive(Default)]
+pub struct History {
+    queue: VecDeque<StoredBuffer>,
+    gops: VecDeque<GopEntry>,
+    // Sequence number of `queue.front()`
+    head_seq: u64,
+    // Bytes held by delta units in front of the first keyframe
+    orphan_bytes: usize,
+    // Total payload bytes held in `queue`
+    bytes: usize,
+    // Older history thinned to keyframes only, all older than `queue`
+    thinned: VecDeque<StoredBuffer>,
+    thinned_bytes: usize,
+    // Sticky events (CAPS, SEGMENT, TAG...) in stream order, each applying
+    // from the buffer with sequence number `seq` on
+    events: VecDeque<(u64, gst::Event)>,
+    // In-band parameter sets (SPS/PPS/VPS) in the stream's framing, each
+    // applying to the keyframes from the buffer with sequence number `seq`
+    // on. None where the codec changed and the older ones no longer apply.
+    parameter_sets: VecDeque<(u64, Option<gst::Memory>)>,
+    // Sequence number following the last buffer sent downstream, when
+    // recording continues while open
+    emitted_seq: Option<u64>,
+}
+
+impl History {
+    pub fn len(&self) -> usize {
+        self.queue.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.queue.is_empty() && self.thinned.is_empty()
+    }
+
+    pub fn thinned_len(&self) -> usize {
+        self.thinned.len()
+    }
+
+    // Payload bytes held in both tiers
+    pub fn bytes(&self) -> usize {
+        self.bytes + self.thinned_bytes
+    }
+
+    pub fn gop_count(&self) -> usize {
+        self.gops.len()
+    }
+
+    pub fn has_orphans(&self) -> bool {
+        self.first_keyframe_index().is_some_and(|idx| idx > 0)
+    }
+
+    // Time span between the oldest and the newest buffer
+    pub fn duration(&self) -> gst::ClockTime {
+        match (self.thinned.front().or(self.queue.front()), self.queue.back()) {
+            (Some(front), Some(back)) => back.timestamp.saturating_sub(front.timestamp),
+            _ => gst::ClockTime::ZERO,
+        }
+    }
+
+    // Sequence number the next pushed buffer gets
+    pub fn next_seq(&self) -> u64 {
+        self.head_seq + self.queue.len() as u64
+    }
+
+    // Sequence number of the oldest buffer in the full-rate queue, or of the
+    // next one if it is empty
+    pub fn front_seq(&self) -> u64 {
+        self.head_seq
+    }
+
+    pub fn newest_timestamp(&self) -> Option<gst::ClockTime> {
+        self.queue.back().map(|stored| stored.timestamp)
+    }
+
+    pub fn get(&self, index: usize) -> Option<&StoredBuffer> {
+        self.queue.get(index)
+    }
+
+    pub fn push(&mut self, stored: StoredBuffer) {
+        debug_assert_eq!(stored.seq, self.next_seq());
+        let size = stored.buffer.size();
+        if stored.is_keyframe {
+            self.gops.push_back(GopEntry {
+                seq: stored.seq,
+                timestamp: stored.timestamp,
+                bytes: size,
+            });
+        } else if let Some(last) = self.gops.back_mut() {
+            last.bytes += size;
+        } else {
+            self.orphan_bytes += size;
+        }
+        self.bytes += size;
+        self.queue.push_back(stored);
+    }
+
+    pub fn pop_front(&mut self) -> Option<StoredBuffer> {
+        let stored = self.queue.pop_front()?;
+        let seq = self.head_seq;
+        self.head_seq += 1;
+
+        let size = stored.buffer.size();
+        self.bytes -= size;
+        match self.gops.front() {
+            Some(gop) if gop.seq == seq => {
+                // The rest of this GOP can no longer be decoded on its own
+                let gop = self.gops.pop_front().unwrap();
+                self.orphan_bytes += gop.bytes - size;
+            }
+            _ => self.orphan_bytes -= size,
+        }
+
+        Some(stored)
+    }
+
+    // Drop any leading delta units plus the oldest GOP.
+    // Returns the number of buffers removed.
+    pub fn pop_gop(&mut self) -> usize {
+        self.take_gop().count()
+    }
+
+    // Remove any leading delta units plus the oldest GOP, handing them out
+    // by value
+    pub fn take_gop(&mut self) -> impl Iterator<Item = StoredBuffer> + '_ {
+        let end = match self.gops.get(1) {
+            Some(next) => next.seq,
+            None => self.head_seq + self.queue.len() as u64,
+        };
+        let count = (end - self.head_seq) as usize;
+        let gop_bytes = self.gops.pop_front().map(|gop| gop.bytes).unwrap_or(0);
+        self.bytes -= self.orphan_bytes + gop_bytes;
+        self.head_seq = end;
+        self.orphan_bytes = 0;
+        self.queue.drain(..count)
+    }
+
+    // Like `pop_gop()`, but the keyframe of the dropped GOP is kept in the
+    // keyframes-only tier.
+    // Returns the number of buffers removed from the full-rate queue.
+    pub fn thin_gop(&mut self) -> usize {
+        let mut count = self.drop_orphans();
+        if let Some(stored) = self.pop_front() {
+            count += 1;
+            if stored.is_keyframe {
+                self.push_thinned(stored);
+            }
+        }
+        // The rest of the GOP is now leading delta units
+        count + self.drop_orphans()
+    }
+
+    pub fn push_thinned(&mut self, stored: StoredBuffer) {
+        self.thinned_bytes += stored.buffer.size();
+        self.thinned.push_back(stored);
+    }
+
+    pub fn pop_thinned(&mut self) -> Option<StoredBuffer> {
+        let stored = self.thinned.pop_front()?;
+        self.thinned_bytes -= stored.buffer.size();
+        Some(stored)
+    }
+
+    pub fn thinned_front_timestamp(&self) -> Option<gst::ClockTime> {
+        self.thinned.front().map(|stored| stored.timestamp)
+    }
+
+    pub fn thinned_front(&self) -> Option<&StoredBuffer> {
+        self.thinned.front()
+    }
+
+    pub fn thinned_front_seq(&self) -> Option<u64> {
+        self.thinned.front().map(|stored| stored.seq)
+    }
+
+    // Empty the keyframes-only tier, handing out its buffers by value
+    pub fn take_thinned(&mut self) -> impl Iterator<Item = StoredBuffer> + '_ {
+        self.thinned_bytes = 0;
+        self.thinned.drain(..)
+    }
+
+    // Drop delta units in front of the oldest keyframe; they cannot be
+    // decoded without the GOP they belonged to.
+    // Returns the number of buffers removed.
+    pub fn drop_orphans(&mut self) -> usize {
+        let count = match self.first_keyframe_index() {
+            Some(idx) => idx,
+            None => return 0,
+        };
+        self.queue.drain(..count);
+        self.head_seq += count as u64;
+        self.bytes -= self.orphan_bytes;
+        self.orphan_bytes = 0;
+        count
+    }
+
+    // Timestamp of the keyframe following the oldest one, i.e. where the
+    // history would start after `pop_gop()`
+    pub fn second_gop_timestamp(&self) -> Option<gst::ClockTime> {
+        self.gops.get(1).map(|gop| gop.timestamp)
+    }
+
+    // Queue index of the oldest keyframe, if any
+    pub fn first_keyframe_index(&self) -> Option<usize> {
+        self.gops.front().map(|gop| (gop.seq - self.head_seq) as usize)
+    }
+
+    // Queue index of the newest keyframe at or before `timestamp`, falling
+    // back to the oldest keyframe if the history does not reach back that far.
+    // GOP timestamps are monotonic, so this is a binary search.
+    pub fn keyframe_index_before(&self, timestamp: gst::ClockTime) -> Option<usize> {
+        let after = self.gops.partition_point(|gop| gop.timestamp <= timestamp);
+        let gop = self.gops.get(after.saturating_sub(1))?;
+        Some((gop.seq - self.head_seq) as usize)
+    }
+
+    pub fn iter_from(&self, index: usize) -> impl Iterator<Item = &StoredBuffer> {
+        self.queue.range(index..)
+    }
+
+    // Mark everything in the queue as sent downstream
+    pub fn mark_emitted(&mut self) {
+        self.emitted_seq = Some(self.head_seq + self.queue.len() as u64);
+    }
+
+    // Queue index of the first buffer not sent downstream yet, if the
+    // history still reaches back to the last one that was
+    pub fn unemitted_index(&self) -> Option<usize> {
+        self.emitted_seq
+            .filter(|seq| *seq >= self.head_seq)
+            .map(|seq| (seq - self.head_seq) as usize)
+    }
+
+    // Empty the full-rate queue, handing out the buffers from `index` on by
+    // value
+    pub fn take_from(&mut self, index: usize) -> impl Iterator<Item = StoredBuffer> + '_ {
+        self.head_seq += self.queue.len() as u64;
+        self.gops.clear();
+        self.orphan_bytes = 0;
+        self.bytes = 0;
+        self.emitted_seq = None;
+        self.queue.drain(..index);
+        self.queue.drain(..)
+    }
+
+    // Record a sticky event in front of the next buffer. An event of the
+    // same type already waiting there is replaced.
+    pub fn push_event(&mut self, event: gst::Event) {
+        let seq = self.next_seq();
+        self.events
+            .retain(|(other_seq, other)| *other_seq != seq || other.type_() != event.type_());
+        self.events.push_back((seq, event));
+    }
+
+    // Record parameter sets applying from the next pushed buffer on
+    pub fn push_parameter_sets(&mut self, sets: Option<gst::Memory>) {
+        let seq = self.next_seq();
+        if self.parameter_sets.back().is_some_and(|(other_seq, _)| *other_seq == seq) {
+            self.parameter_sets.pop_back();
+        }
+        self.parameter_sets.push_back((seq, sets));
+    }
+
+    // Parameter sets in effect at the buffer with sequence number `seq`
+    pub fn parameter_sets_for(&self, seq: u64) -> Option<gst::Memory> {
+        let after = self.parameter_sets.partition_point(|(other_seq, _)| *other_seq <= seq);
+        self.parameter_sets.get(after.checked_sub(1)?)?.1.clone()
+    }
+
+    // Forget the stream state superseded in front of `seq`, which must be
+    // the oldest buffer still held in any tier, including the spill ring the
+    // history does not know about
+    pub fn collapse_metadata(&mut self, seq: u64) {
+        self.collapse_events(seq);
+        let applying = self.parameter_sets.partition_point(|(other_seq, _)| *other_seq <= seq);
+        self.parameter_sets.drain(..applying.saturating_sub(1));
+    }
+
+    // Events in front of `seq` only matter as the state that applies to
+    // the buffer at `seq`: keep the latest of each type there, in order
+    fn collapse_events(&mut self, seq: u64) {
+        collapse_events(&mut self.events, seq);
+    }
+
+    // Hand out the stored events for a dump starting at the buffer with
+    // sequence number `start_seq`, each with the sequence number of the
+    // buffer it precedes. The ones in front of `start_seq` are collapsed to
+    // the state applying to that buffer.
+    pub fn take_events(&mut self, start_seq: u64) -> VecDeque<(u64, gst::Event)> {
+        self.collapse_events(start_seq);
+        std::mem::take(&mut self.events)
+    }
+
+    // Like `take_events()`, but the stored events stay in place, still
+    // describing the older buffers of a history that is kept after the dump
+    pub fn events_from(&self, start_seq: u64) -> VecDeque<(u64, gst::Event)> {
+        let mut events = self.events.clone();
+        collapse_events(&mut events, start_seq);
+        events
+    }
+
+    // Drop all buffers. Stored events are kept, collapsed, as they still
+    // describe the stream that follows.
+    pub fn clear(&mut self) {
+        self.head_seq += self.queue.len() as u64;
+        self.queue.clear();
+        self.gops.clear();
+        self.orphan_bytes = 0;
+        self.bytes = 0;
+        self.thinned.clear();
+        self.thinned_bytes = 0;
+        self.emitted_seq = None;
+        self.collapse_metadata(self.head_seq);
+    }
+}
+
+fn collapse_events(events: &mut VecDeque<(u64, gst::Event)>, seq: u64) {
+    let mut i = 0;
+    while i < events.len() && events[i].0 <= seq {
+        let event_type = events[i].1.type_();
+        let superseded = events
+            .iter()
+            .skip(i + 1)
+            .take_while(|(other_seq, _)| *other_seq <= seq)
+            .any(|(_, other)| other.type_() == event_type);
+        if superseded {
+            events.remove(i);
+        } else {
+            i += 1;
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    // Push 10 byte buffers following `pattern`, K for a keyframe and d for
+    // a delta unit, with one second between timestamps starting at 1s
+    fn push_pattern(history: &mut History, pattern: &str) {
+        gst::init().unwrap();
+        for kind in pattern.chars() {
+            let seq = history.next_seq();
+            history.push(StoredBuffer {
+                buffer: gst::Buffer::with_size(10).unwrap(),
+                seq,
+                timestamp: gst::ClockTime::from_seconds(seq + 1),
+                is_keyframe: kind == 'K',
+            });
+        }
+    }
+
+    fn caps_event(name: &str) -> gst::Event {
+        gst::event::Caps::new(&gst::Caps::new_empty_simple(name))
+    }
+
+    fn caps_name(event: &gst::Event) -> String {
+        match event.view() {
+            gst::EventView::Caps(caps) => caps.caps().structure(0).unwrap().name().to_string(),
+            _ => unreachable!(),
+        }
+    }
+
+    #[test]
+    fn gop_index_follows_pops() {
+        let mut history = History::default();
+        push_pattern(&mut history, "KddKdKd");
+        assert_eq!(history.len(), 7);
+        assert_eq!(history.gop_count(), 3);
+        assert_eq!(history.bytes(), 70);
+        assert_eq!(history.first_keyframe_index(), Some(0));
+        assert!(!history.has_orphans());
+
+        // Popping a keyframe leaves the rest of its GOP as orphans
+        history.pop_front();
+        assert_eq!(history.first_keyframe_index(), Some(2));
+        assert!(history.has_orphans());
+        assert_eq!(history.gop_count(), 2);
+
+        assert_eq!(history.drop_orphans(), 2);
+        assert_eq!(history.first_keyframe_index(), Some(0));
+        assert_eq!(history.get(0).unwrap().seq, 3);
+        assert_eq!(history.bytes(), 40);
+
+        assert_eq!(history.pop_gop(), 2);
+        assert_eq!(history.len(), 2);
+        assert_eq!(history.gop_count(), 1);
+        assert_eq!(history.bytes(), 20);
+        assert_eq!(history.front_seq(), 5);
+        assert_eq!(history.next_seq(), 7);
+
+        // The last GOP runs to the end of the queue
+        assert_eq!(history.pop_gop(), 2);
+        assert!(history.is_empty());
+        assert_eq!(history.bytes(), 0);
+        assert_eq!(history.next_seq(), 7);
+    }
+
+    #[test]
+    fn keyframe_index_before() {
+        let mut history = History::default();
+        assert_eq!(history.keyframe_index_before(gst::ClockTime::from_seconds(5)), None);
+
+        // Keyframes at 1s, 4s and 6s
+        push_pattern(&mut history, "KddKdKd");
+        let before = |secs| history.keyframe_index_before(gst::ClockTime::from_seconds(secs));
+        assert_eq!(before(0), Some(0));
+        assert_eq!(before(1), Some(0));
+        assert_eq!(before(3), Some(0));
+        assert_eq!(before(4), Some(3));
+        assert_eq!(before(5), Some(3));
+        assert_eq!(before(100), Some(5));
+
+        // Indices stay relative to the front of the queue
+        history.pop_front();
+        assert_eq!(history.keyframe_index_before(gst::ClockTime::from_seconds(5)), Some(2));
+    }
+
+    #[test]
+    fn thin_gop_keeps_the_keyframe() {
+        let mut history = History::default();
+        push_pattern(&mut history, "KddKdKd");
+        assert_eq!(history.thin_gop(), 3);
+        assert_eq!(history.thinned_len(), 1);
+        assert_eq!(history.thinned_front_seq(), Some(0));
+        assert_eq!(history.len(), 4);
+        assert_eq!(history.first_keyframe_index(), Some(0));
+        assert_eq!(history.bytes(), 50);
+        assert_eq!(history.duration(), gst::ClockTime::from_seconds(6));
+
+        let thinned: Vec<u64> = history.take_thinned().map(|stored| stored.seq).collect();
+        assert_eq!(thinned, [0]);
+        assert_eq!(history.bytes(), 40);
+    }
+
+    #[test]
+    fn emitted_position_survives_pops() {
+        let mut history = History::default();
+        push_pattern(&mut history, "Kdd");
+        history.mark_emitted();
+        push_pattern(&mut history, "Kd");
+        assert_eq!(history.unemitted_index(), Some(3));
+
+        history.pop_gop();
+        assert_eq!(history.unemitted_index(), Some(0));
+
+        let taken: Vec<u64> = history.take_from(1).map(|stored| stored.seq).collect();
+        assert_eq!(taken, [4]);
+        assert_eq!(history.unemitted_index(), None);
+        assert_eq!(history.next_seq(), 5);
+    }
+
+    #[test]
+    fn events_keep_their_sequence_numbers() {
+        let mut history = History::default();
+        history.push_event(caps_event("video/x-h264"));
+        push_pattern(&mut history, "Kd");
+        history.push_event(caps_event("video/x-h265"));
+        // Replaces the previous one in front of the same buffer
+        history.push_event(caps_event("video/x-vp9"));
+        push_pattern(&mut history, "Kd");
+
+        let events = history.take_events(0);
+        let events: Vec<(u64, String)> =
+            events.iter().map(|(seq, event)| (*seq, caps_name(event))).collect();
+        assert_eq!(
+            events,
+            [(0, "video/x-h264".to_string()), (2, "video/x-vp9".to_string())]
+        );
+    }
+
+    #[test]
+    fn events_collapse_in_front_of_the_oldest_buffer() {
+        let mut history = History::default();
+        history.push_event(caps_event("video/x-h264"));
+        push_pattern(&mut history, "Kd");
+        history.push_event(caps_event("video/x-h265"));
+        push_pattern(&mut history, "KdKd");
+
+        // Only the state applying to the first remaining buffer is left
+        history.pop_gop();
+        history.collapse_metadata(history.front_seq());
+        let events = history.take_events(history.front_seq());
+        assert_eq!(events.len(), 1);
+        assert_eq!(events[0].0, 2);
+        assert_eq!(caps_name(&events[0].1), "video/x-h265");
+    }
+
+    #[test]
+    fn events_from_leaves_the_history_untouched() {
+        let mut history = History::default();
+        history.push_event(caps_event("video/x-h264"));
+        push_pattern(&mut history, "Kd");
+        history.push_event(caps_event("video/x-h265"));
+        push_pattern(&mut history, "Kd");
+
+        let events = history.events_from(2);
+        assert_eq!(events.len(), 1);
+        assert_eq!(events[0].0, 2);
+
+        // A later dump from the start still gets every event
+        let events = history.take_events(0);
+        let events: Vec<(u64, String)> =
+            events.iter().map(|(seq, event)| (*seq, caps_name(event))).collect();
+        assert_eq!(
+            events,
+            [(0, "video/x-h264".to_string()), (2, "video/x-h265".to_string())]
+        );
+    }
+
+    #[test]
+    fn parameter_sets_per_gop() {
+        gst::init().unwrap();
+        let sets = |history: &History, seq| {
+            history
+                .parameter_sets_for(seq)
+                .map(|sets| sets.map_readable().unwrap().as_slice().to_vec())
+        };
+
+        let mut history = History::default();
+        assert_eq!(sets(&history, 0), None);
+        history.push_parameter_sets(Some(gst::Memory::from_slice(b"a")));
+        push_pattern(&mut history, "Kd");
+        history.push_parameter_sets(Some(gst::Memory::from_slice(b"b")));
+        push_pattern(&mut history, "Kd");
+        history.push_parameter_sets(None);
+        push_pattern(&mut history, "Kd");
+
+        assert_eq!(sets(&history, 1), Some(b"a".to_vec()));
+        assert_eq!(sets(&history, 2), Some(b"b".to_vec()));
+        assert_eq!(sets(&history, 3), Some(b"b".to_vec()));
+        assert_eq!(sets(&history, 4), None);
+
+        // The sets still applying to the oldest buffer are kept
+        history.pop_gop();
+        history.collapse_metadata(history.front_seq() + 1);
+        assert_eq!(sets(&history, 3), Some(b"b".to_vec()));
+        assert_eq!(sets(&history, 5), None);
+    }
+}
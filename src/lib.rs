@@ -2,8 +2,13 @@ use gstreamer as gst;
 use glib::translate::from_glib_borrow;
 use std::os::raw::c_char;
 
+mod arena;
+mod bitstream;
+mod budget;
+mod history;
 mod plugin;
 mod prerollvalve;
+mod spill;
 
 fn plugin_init(plugin: &gst::Plugin) -> Result<(), glib::BoolError> {
     plugin::plugin_init(plugin)
@@ -1,24 +1,172 @@
 use gstreamer as gst;
+use gstreamer_video as gst_video;
 use glib::prelude::*;
 use gst::prelude::*;
 use std::collections::VecDeque;
-use std::sync::Mutex;
+use std::sync::atomic::{AtomicBool, AtomicU32, AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, Condvar, Mutex};
+use std::time::{Duration, Instant};
 use once_cell::sync::Lazy;
 
+use crate::arena::Arena;
+use crate::bitstream::{Codec, FrameInfo};
+use crate::budget::{self, BudgetSlot};
+use crate::history::{History, StoredBuffer};
+use crate::spill::SpillRing;
+
 // Example pipeline:
 // gst-launch-1.0 filesrc location=video.h264 ! h264parse ! prerollvalve open=true max-history=5000 ! h264parse ! avdec_h264 ! autovideosink
 
 // Property defaults
 const DEFAULT_OPEN: bool = false;
 const DEFAULT_MAX_HISTORY: u64 = 5000; // ms
+const DEFAULT_KEYFRAME_HISTORY: u64 = 0; // ms, disabled
 const DEFAULT_DEBUG: bool = false;
+const DEFAULT_MAX_BYTES: u64 = 0; // unlimited
+const DEFAULT_MAX_BUFFERS: u32 = 0; // unlimited
+const DEFAULT_DUMP_CHUNK_SIZE: u32 = 0; // one list per GOP
+const DEFAULT_DUMP_RATE: u64 = 0; // bytes/s, unlimited
+const DEFAULT_DUMP_SPEED: f64 = 0.0; // unlimited
+const DEFAULT_SPILL_SIZE: u64 = 1024 * 1024 * 1024; // bytes
+const DEFAULT_SPILL_HORIZON: u64 = 2000; // ms
+const DEFAULT_COPY_ON_STORE: bool = false;
+const DEFAULT_RECORD_WHILE_OPEN: bool = false;
+const DEFAULT_POST_ROLL: u64 = 0; // ms, disabled
+const DEFAULT_POST_ROLL_GOPS: u32 = 0; // disabled
+const DEFAULT_MAX_PENDING_BYTES: u64 = 64 * 1024 * 1024; // bytes
+const DEFAULT_MAX_PENDING_BUFFERS: u32 = 0; // unlimited
+const DEFAULT_MAX_PENDING_TIME: u64 = 10000; // ms
+
+// Custom event (downstream or upstream) scheduling an open or close:
+//   prerollvalve-trigger, action=(string){open,close}, running-time=(guint64)
+const TRIGGER_EVENT: &str = "prerollvalve-trigger";
+const DEFAULT_ARENA_SIZE: u64 = 64 * 1024 * 1024; // bytes
+const DEFAULT_EVICTION_MODE: EvictionMode = EvictionMode::Buffer;
+const DEFAULT_KEYFRAME_ON_OPEN: KeyframeOnOpen = KeyframeOnOpen::Request;
+const DEFAULT_KEYFRAME_DETECTION: KeyframeDetection = KeyframeDetection::Flags;
+const DEFAULT_RETENTION_TIME: RetentionTime = RetentionTime::RunningTime;
+const DEFAULT_OUTPUT_TIMESTAMPS: OutputTimestamps = OutputTimestamps::Original;
+const DEFAULT_LEAKY: Leaky = Leaky::No;
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveEvictionMode")]
+pub enum EvictionMode {
+    #[enum_value(name = "Buffer: drop single buffers older than max-history", nick = "buffer")]
+    Buffer = 0,
+    #[enum_value(
+        name = "GOP: drop whole GOPs and always keep one complete GOP",
+        nick = "gop"
+    )]
+    Gop = 1,
+}
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveKeyframeOnOpen")]
+pub enum KeyframeOnOpen {
+    #[enum_value(name = "None: start output right away, whatever the first buffer is", nick = "none")]
+    None = 0,
+    #[enum_value(
+        name = "Request: ask upstream for a keyframe if the history holds none",
+        nick = "request"
+    )]
+    Request = 1,
+    #[enum_value(
+        name = "Wait: request a keyframe and drop delta units until it arrives",
+        nick = "wait"
+    )]
+    Wait = 2,
+}
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveKeyframeDetection")]
+pub enum KeyframeDetection {
+    #[enum_value(name = "Flags: trust the DELTA_UNIT buffer flag", nick = "flags")]
+    Flags = 0,
+    #[enum_value(
+        name = "Bitstream: parse NAL/OBU headers for H.264, H.265, VP8, VP9 and AV1, flags otherwise",
+        nick = "bitstream"
+    )]
+    Bitstream = 1,
+}
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveRetentionTime")]
+pub enum RetentionTime {
+    #[enum_value(
+        name = "Running time: buffer timestamps converted with the current segment",
+        nick = "running-time"
+    )]
+    RunningTime = 0,
+    #[enum_value(
+        name = "Arrival time: running time of the pipeline clock when the buffer arrived",
+        nick = "arrival-time"
+    )]
+    ArrivalTime = 1,
+}
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveOutputTimestamps")]
+pub enum OutputTimestamps {
+    #[enum_value(name = "Original: keep the stored timestamps", nick = "original")]
+    Original = 0,
+    #[enum_value(
+        name = "Rebase: shift buffer timestamps so the dump starts at the current running time",
+        nick = "rebase"
+    )]
+    Rebase = 1,
+    #[enum_value(
+        name = "Segment: offset the output segment so the dump starts at the current running time",
+        nick = "segment"
+    )]
+    Segment = 2,
+}
+
+#[derive(Debug, Eq, PartialEq, Ord, PartialOrd, Hash, Clone, Copy, glib::Enum)]
+#[repr(u32)]
+#[enum_type(name = "GstPrerollValveLeaky")]
+pub enum Leaky {
+    #[enum_value(name = "No: block upstream while live data queued for output is over the max-pending limits", nick = "no")]
+    No = 0,
+    #[enum_value(
+        name = "Upstream: drop live data over the max-pending limits, up to the next keyframe",
+        nick = "upstream"
+    )]
+    Upstream = 1,
+}
 
 // Properties
 #[derive(Debug, Clone, Copy)]
 struct Settings {
     open: bool,
     max_history: u64,
+    keyframe_history: u64,
+    max_bytes: u64,
+    max_buffers: u32,
     debug: bool,
+    eviction_mode: EvictionMode,
+    keyframe_on_open: KeyframeOnOpen,
+    keyframe_detection: KeyframeDetection,
+    retention_time: RetentionTime,
+    output_timestamps: OutputTimestamps,
+    dump_chunk_size: u32,
+    dump_rate: u64,
+    dump_speed: f64,
+    spill_size: u64,
+    spill_horizon: u64,
+    copy_on_store: bool,
+    arena_size: u64,
+    record_while_open: bool,
+    post_roll: u64,
+    post_roll_gops: u32,
+    max_pending_bytes: u64,
+    max_pending_buffers: u32,
+    max_pending_time: u64,
+    leaky: Leaky,
 }
 
 impl Default for Settings {
@@ -26,154 +174,1971 @@ impl Default for Settings {
         Self {
             open: DEFAULT_OPEN,
             max_history: DEFAULT_MAX_HISTORY,
+            keyframe_history: DEFAULT_KEYFRAME_HISTORY,
+            max_bytes: DEFAULT_MAX_BYTES,
+            max_buffers: DEFAULT_MAX_BUFFERS,
             debug: DEFAULT_DEBUG,
+            eviction_mode: DEFAULT_EVICTION_MODE,
+            keyframe_on_open: DEFAULT_KEYFRAME_ON_OPEN,
+            keyframe_detection: DEFAULT_KEYFRAME_DETECTION,
+            retention_time: DEFAULT_RETENTION_TIME,
+            output_timestamps: DEFAULT_OUTPUT_TIMESTAMPS,
+            dump_chunk_size: DEFAULT_DUMP_CHUNK_SIZE,
+            dump_rate: DEFAULT_DUMP_RATE,
+            dump_speed: DEFAULT_DUMP_SPEED,
+            spill_size: DEFAULT_SPILL_SIZE,
+            spill_horizon: DEFAULT_SPILL_HORIZON,
+            copy_on_store: DEFAULT_COPY_ON_STORE,
+            arena_size: DEFAULT_ARENA_SIZE,
+            record_while_open: DEFAULT_RECORD_WHILE_OPEN,
+            post_roll: DEFAULT_POST_ROLL,
+            post_roll_gops: DEFAULT_POST_ROLL_GOPS,
+            max_pending_bytes: DEFAULT_MAX_PENDING_BYTES,
+            max_pending_buffers: DEFAULT_MAX_PENDING_BUFFERS,
+            max_pending_time: DEFAULT_MAX_PENDING_TIME,
+            leaky: DEFAULT_LEAKY,
+        }
+    }
+}
+
+// Property storage. Each property is its own atomic so the streaming
+// threads read a `Settings` snapshot without ever contending with the
+// application setting or polling properties.
+struct SharedSettings {
+    open: AtomicBool,
+    max_history: AtomicU64,
+    keyframe_history: AtomicU64,
+    max_bytes: AtomicU64,
+    max_buffers: AtomicU32,
+    debug: AtomicBool,
+    eviction_mode: AtomicU32,
+    keyframe_on_open: AtomicU32,
+    keyframe_detection: AtomicU32,
+    retention_time: AtomicU32,
+    output_timestamps: AtomicU32,
+    dump_chunk_size: AtomicU32,
+    dump_rate: AtomicU64,
+    // f64 bits
+    dump_speed: AtomicU64,
+    spill_size: AtomicU64,
+    spill_horizon: AtomicU64,
+    copy_on_store: AtomicBool,
+    arena_size: AtomicU64,
+    record_while_open: AtomicBool,
+    post_roll: AtomicU64,
+    post_roll_gops: AtomicU32,
+    max_pending_bytes: AtomicU64,
+    max_pending_buffers: AtomicU32,
+    max_pending_time: AtomicU64,
+    leaky: AtomicU32,
+    // Only read when the element starts, so a plain mutex is fine
+    spill_directory: Mutex<Option<String>>,
+}
+
+impl SharedSettings {
+    fn snapshot(&self) -> Settings {
+        Settings {
+            open: self.open.load(Ordering::Relaxed),
+            max_history: self.max_history.load(Ordering::Relaxed),
+            keyframe_history: self.keyframe_history.load(Ordering::Relaxed),
+            max_bytes: self.max_bytes.load(Ordering::Relaxed),
+            max_buffers: self.max_buffers.load(Ordering::Relaxed),
+            debug: self.debug.load(Ordering::Relaxed),
+            eviction_mode: match self.eviction_mode.load(Ordering::Relaxed) {
+                mode if mode == EvictionMode::Gop as u32 => EvictionMode::Gop,
+                _ => EvictionMode::Buffer,
+            },
+            keyframe_on_open: match self.keyframe_on_open.load(Ordering::Relaxed) {
+                mode if mode == KeyframeOnOpen::None as u32 => KeyframeOnOpen::None,
+                mode if mode == KeyframeOnOpen::Wait as u32 => KeyframeOnOpen::Wait,
+                _ => KeyframeOnOpen::Request,
+            },
+            keyframe_detection: match self.keyframe_detection.load(Ordering::Relaxed) {
+                mode if mode == KeyframeDetection::Bitstream as u32 => KeyframeDetection::Bitstream,
+                _ => KeyframeDetection::Flags,
+            },
+            retention_time: match self.retention_time.load(Ordering::Relaxed) {
+                mode if mode == RetentionTime::ArrivalTime as u32 => RetentionTime::ArrivalTime,
+                _ => RetentionTime::RunningTime,
+            },
+            output_timestamps: match self.output_timestamps.load(Ordering::Relaxed) {
+                mode if mode == OutputTimestamps::Rebase as u32 => OutputTimestamps::Rebase,
+                mode if mode == OutputTimestamps::Segment as u32 => OutputTimestamps::Segment,
+                _ => OutputTimestamps::Original,
+            },
+            dump_chunk_size: self.dump_chunk_size.load(Ordering::Relaxed),
+            dump_rate: self.dump_rate.load(Ordering::Relaxed),
+            dump_speed: f64::from_bits(self.dump_speed.load(Ordering::Relaxed)),
+            spill_size: self.spill_size.load(Ordering::Relaxed),
+            spill_horizon: self.spill_horizon.load(Ordering::Relaxed),
+            copy_on_store: self.copy_on_store.load(Ordering::Relaxed),
+            arena_size: self.arena_size.load(Ordering::Relaxed),
+            record_while_open: self.record_while_open.load(Ordering::Relaxed),
+            post_roll: self.post_roll.load(Ordering::Relaxed),
+            post_roll_gops: self.post_roll_gops.load(Ordering::Relaxed),
+            max_pending_bytes: self.max_pending_bytes.load(Ordering::Relaxed),
+            max_pending_buffers: self.max_pending_buffers.load(Ordering::Relaxed),
+            max_pending_time: self.max_pending_time.load(Ordering::Relaxed),
+            leaky: match self.leaky.load(Ordering::Relaxed) {
+                mode if mode == Leaky::Upstream as u32 => Leaky::Upstream,
+                _ => Leaky::No,
+            },
+        }
+    }
+}
+
+impl Default for SharedSettings {
+    fn default() -> Self {
+        let settings = Settings::default();
+        Self {
+            open: AtomicBool::new(settings.open),
+            max_history: AtomicU64::new(settings.max_history),
+            keyframe_history: AtomicU64::new(settings.keyframe_history),
+            max_bytes: AtomicU64::new(settings.max_bytes),
+            max_buffers: AtomicU32::new(settings.max_buffers),
+            debug: AtomicBool::new(settings.debug),
+            eviction_mode: AtomicU32::new(settings.eviction_mode as u32),
+            keyframe_on_open: AtomicU32::new(settings.keyframe_on_open as u32),
+            keyframe_detection: AtomicU32::new(settings.keyframe_detection as u32),
+            retention_time: AtomicU32::new(settings.retention_time as u32),
+            output_timestamps: AtomicU32::new(settings.output_timestamps as u32),
+            dump_chunk_size: AtomicU32::new(settings.dump_chunk_size),
+            dump_rate: AtomicU64::new(settings.dump_rate),
+            dump_speed: AtomicU64::new(settings.dump_speed.to_bits()),
+            spill_size: AtomicU64::new(settings.spill_size),
+            spill_horizon: AtomicU64::new(settings.spill_horizon),
+            copy_on_store: AtomicBool::new(settings.copy_on_store),
+            arena_size: AtomicU64::new(settings.arena_size),
+            record_while_open: AtomicBool::new(settings.record_while_open),
+            post_roll: AtomicU64::new(settings.post_roll),
+            post_roll_gops: AtomicU32::new(settings.post_roll_gops),
+            max_pending_bytes: AtomicU64::new(settings.max_pending_bytes),
+            max_pending_buffers: AtomicU32::new(settings.max_pending_buffers),
+            max_pending_time: AtomicU64::new(settings.max_pending_time),
+            leaky: AtomicU32::new(settings.leaky as u32),
+            spill_directory: Mutex::new(None),
+        }
+    }
+}
+
+// Serialized data waiting to be pushed by the src pad task
+enum Item {
+    Buffer(gst::Buffer),
+    List(gst::BufferList),
+    Event(gst::Event),
+    // New src pad offset, applied in stream order
+    Offset(i64),
+}
+
+impl Item {
+    // Stream time (decode order) and size of the data, for dump pacing
+    fn pacing_info(&self) -> Option<(Option<gst::ClockTime>, u64)> {
+        match self {
+            Item::Buffer(buffer) => Some((buffer.dts().or(buffer.pts()), buffer.size() as u64)),
+            Item::List(list) => {
+                let ts = list.get(0).and_then(|buffer| buffer.dts().or(buffer.pts()));
+                Some((ts, list.calculate_size() as u64))
+            }
+            Item::Event(..) | Item::Offset(..) => None,
+        }
+    }
+}
+
+struct PendingItem {
+    item: Item,
+    ts: Option<gst::ClockTime>,
+    bytes: u64,
+    buffers: usize,
+    // Live data counts against the `max-pending-*` limits, the dump not
+    live: bool,
+}
+
+// Items waiting for the src pad task, with their fill level. Only the live
+// data queued behind a dump is bounded; the dump itself always goes in.
+#[derive(Default)]
+struct PendingQueue {
+    items: VecDeque<PendingItem>,
+    bytes: u64,
+    buffers: usize,
+    live_bytes: u64,
+    live_buffers: usize,
+    // Timestamps of the queued live data, oldest first
+    live_times: VecDeque<gst::ClockTime>,
+}
+
+impl PendingQueue {
+    fn push(&mut self, item: Item, live: bool) {
+        let (ts, bytes) = item.pacing_info().unwrap_or((None, 0));
+        let buffers = match &item {
+            Item::Buffer(..) => 1,
+            Item::List(list) => list.len(),
+            _ => 0,
+        };
+        self.bytes += bytes;
+        self.buffers += buffers;
+        if live {
+            self.live_bytes += bytes;
+            self.live_buffers += buffers;
+            if let Some(ts) = ts {
+                self.live_times.push_back(ts);
+            }
+        }
+        self.items.push_back(PendingItem {
+            item,
+            ts,
+            bytes,
+            buffers,
+            live,
+        });
+    }
+
+    // Dumped history
+    fn push_dump(&mut self, item: Item) {
+        self.push(item, false);
+    }
+
+    // Live data and events
+    fn push_live(&mut self, item: Item) {
+        self.push(item, true);
+    }
+
+    fn pop_front(&mut self) -> Option<Item> {
+        let pending = self.items.pop_front()?;
+        self.bytes -= pending.bytes;
+        self.buffers -= pending.buffers;
+        if pending.live {
+            self.live_bytes -= pending.bytes;
+            self.live_buffers -= pending.buffers;
+            if pending.ts.is_some() {
+                self.live_times.pop_front();
+            }
         }
+        Some(pending.item)
     }
+
+    fn is_empty(&self) -> bool {
+        self.items.is_empty()
+    }
+
+    fn clear(&mut self) {
+        *self = Self::default();
+    }
+
+    fn bytes(&self) -> u64 {
+        self.bytes
+    }
+
+    fn buffers(&self) -> usize {
+        self.buffers
+    }
+
+    // Time span of everything queued
+    fn duration(&self) -> gst::ClockTime {
+        let front = self.items.iter().find_map(|pending| pending.ts);
+        let back = self.items.iter().rev().find_map(|pending| pending.ts);
+        match (front, back) {
+            (Some(front), Some(back)) => back.saturating_sub(front),
+            _ => gst::ClockTime::ZERO,
+        }
+    }
+
+    // Whether the queued live data reached any of the `max-pending-*` limits
+    fn is_full(&self, settings: &Settings) -> bool {
+        let live_time = match (self.live_times.front(), self.live_times.back()) {
+            (Some(front), Some(back)) => back.saturating_sub(*front),
+            _ => gst::ClockTime::ZERO,
+        };
+        (settings.max_pending_bytes > 0 && self.live_bytes >= settings.max_pending_bytes)
+            || (settings.max_pending_buffers > 0
+                && self.live_buffers >= settings.max_pending_buffers as usize)
+            || (settings.max_pending_time > 0
+                && live_time >= gst::ClockTime::from_mseconds(settings.max_pending_time))
+    }
+}
+
+// Pacing of a catch-up dump, from the dump until the pending queue drains
+#[derive(Default)]
+struct Pacing {
+    // Clock time and stream time of the first paced buffer
+    anchor: Option<(gst::ClockTime, gst::ClockTime)>,
+    // Token bucket for `dump-rate`, holding at most one second worth
+    tokens: u64,
+    last_refill: Option<gst::ClockTime>,
+}
+
+impl Pacing {
+    fn new(settings: &Settings) -> Self {
+        Self {
+            tokens: settings.dump_rate,
+            ..Default::default()
+        }
+    }
+
+    // Clock time at which an item of `size` bytes starting at stream time
+    // `ts` may go out
+    fn deadline(
+        &mut self,
+        settings: &Settings,
+        now: gst::ClockTime,
+        ts: Option<gst::ClockTime>,
+        size: u64,
+    ) -> gst::ClockTime {
+        let mut deadline = now;
+
+        if settings.dump_speed > 0.0 {
+            if let Some(ts) = ts {
+                let (anchor_clock, anchor_ts) = *self.anchor.get_or_insert((now, ts));
+                let offset = ts.saturating_sub(anchor_ts).nseconds() as f64 / settings.dump_speed;
+                deadline = deadline.max(anchor_clock + gst::ClockTime::from_nseconds(offset as u64));
+            }
+        }
+
+        let rate = settings.dump_rate;
+        if rate > 0 {
+            let last = self.last_refill.unwrap_or(now);
+            let refill = now.saturating_sub(last).nseconds() as u128 * rate as u128 / 1_000_000_000;
+            self.tokens = (self.tokens as u128 + refill).min(rate as u128) as u64;
+            self.last_refill = Some(now.max(last));
+            if self.tokens >= size {
+                self.tokens -= size;
+            } else {
+                let missing = (size - self.tokens) as u128 * 1_000_000_000 / rate as u128;
+                let refilled_at = now + gst::ClockTime::from_nseconds(missing as u64);
+                self.tokens = 0;
+                self.last_refill = Some(refilled_at);
+                deadline = deadline.max(refilled_at);
+            }
+        }
+
+        deadline
+    }
+}
+
+// Post-roll of the current open, counted from the first live buffer after
+// the last trigger
+#[derive(Default)]
+struct PostRoll {
+    start: Option<gst::ClockTime>,
+    keyframes: u32,
 }
 
-struct StoredBuffer {
-    buffer: gst::Buffer,
-    timestamp: gst::ClockTime,
-    is_keyframe: bool,
-}
+struct State {
+    history: History,
+    // Full-rate history older than `spill-horizon`, if spilling to disk
+    spill: Option<SpillRing>,
+    // Private storage for payloads in copy-on-store mode
+    arena: Option<Arena>,
+    // Codec from the current caps, for bitstream keyframe detection
+    codec: Option<Codec>,
+    // Current input segment, to convert buffer timestamps to running time
+    segment: gst::FormattedSegment<gst::ClockTime>,
+    pending: PendingQueue,
+    // The streaming thread is blocked on a full pending queue
+    waiting_for_space: bool,
+    // Leaky mode dropped live data; everything up to the next keyframe
+    // that fits goes too
+    leaking: bool,
+    flushing: bool,
+    // Last flow return of the src pad task, reported back upstream
+    flow: Result<gst::FlowSuccess, gst::FlowError>,
+    // When the valve was last opened, until its first buffer goes out
+    opened_at: Option<Instant>,
+    // Time from the last open until its first buffer was pushed
+    open_latency: Option<Duration>,
+    // Opened without a keyframe in `keyframe-on-open=wait` mode: live delta
+    // units are dropped until the next keyframe
+    awaiting_keyframe: bool,
+    // Set while a paced dump is catching up
+    pacing: Option<Pacing>,
+    // Shift applied to output timestamps while open with
+    // `output-timestamps=rebase`
+    rebase: Option<gst::ClockTime>,
+    // Src pad offset once everything in `pending` has gone out
+    src_offset: i64,
+    // Armed while open with `post-roll` or `post-roll-gops` set
+    post_roll: Option<PostRoll>,
+    // Running times of pending `open-at` / `close-at` actions, from the
+    // properties or trigger events
+    scheduled_open: Option<gst::ClockTime>,
+    scheduled_close: Option<gst::ClockTime>,
+    // Running time of the last buffer checked against the scheduled actions
+    position: Option<gst::ClockTime>,
+    // Clock wait of the src pad task, unscheduled on flush
+    clock_wait: Option<gst::SingleShotClockId>,
+}
+
+impl Default for State {
+    fn default() -> Self {
+        Self {
+            history: History::default(),
+            spill: None,
+            arena: None,
+            codec: None,
+            segment: gst::FormattedSegment::new(),
+            pending: PendingQueue::default(),
+            waiting_for_space: false,
+            leaking: false,
+            flushing: true,
+            flow: Err(gst::FlowError::Flushing),
+            opened_at: None,
+            open_latency: None,
+            awaiting_keyframe: false,
+            pacing: None,
+            clock_wait: None,
+            rebase: None,
+            src_offset: 0,
+            post_roll: None,
+            scheduled_open: None,
+            scheduled_close: None,
+            position: None,
+        }
+    }
+}
+
+fn prune_history(
+    history: &mut History,
+    spill: Option<&mut SpillRing>,
+    settings: &Settings,
+    current_ts: gst::ClockTime,
+) {
+    let max_history = gst::ClockTime::from_mseconds(settings.max_history);
+    let keyframe_history = gst::ClockTime::from_mseconds(settings.keyframe_history);
+    let older_than =
+        move |window: gst::ClockTime| move |ts: gst::ClockTime| current_ts > ts && (current_ts - ts) > window;
+    let is_expired = older_than(max_history);
+    // Full-rate history leaving the window is thinned to its keyframes
+    // instead of being dropped
+    let thin = keyframe_history > max_history;
+
+    if let Some(spill) = spill {
+        // Whole GOPs past the in-RAM horizon move to disk, and leave the
+        // disk once past max-history
+        let in_ram_expired = older_than(gst::ClockTime::from_mseconds(settings.spill_horizon));
+        while history.second_gop_timestamp().is_some_and(in_ram_expired) {
+            if !spill.write_gop(history.take_gop()) {
+                gst::warning!(CAT, "Spill ring full, dropped a GOP");
+            }
+        }
+
+        while spill.second_gop_timestamp().is_some_and(is_expired) {
+            if let Some(keyframe) = spill.pop_gop(thin) {
+                history.push_thinned(keyframe);
+            }
+        }
+    }
+
+    match settings.eviction_mode {
+        EvictionMode::Buffer => {
+            // Whole GOPs first: if the next keyframe is already out of the
+            // window, so is everything before it
+            while history.second_gop_timestamp().is_some_and(is_expired) {
+                if thin {
+                    history.thin_gop();
+                } else {
+                    history.pop_gop();
+                }
+            }
+
+            while let Some(front) = history.get(0) {
+                if is_expired(front.timestamp) {
+                    let stored = history.pop_front().unwrap();
+                    if thin && stored.is_keyframe {
+                        history.push_thinned(stored);
+                    }
+                } else {
+                    break;
+                }
+            }
+        }
+        EvictionMode::Gop => {
+            history.drop_orphans();
+
+            // A GOP is only dropped once the keyframe after it has
+            // left the window, so the last GOP is never evicted
+            while history.second_gop_timestamp().is_some_and(is_expired) {
+                if thin {
+                    history.thin_gop();
+                } else {
+                    history.pop_gop();
+                }
+            }
+        }
+    }
+
+    while history.thinned_front_timestamp().is_some_and(older_than(keyframe_history)) {
+        history.pop_thinned();
+    }
+
+    // Hard memory bounds apply in every mode, and also cover streams
+    // without timestamps where the time window never expires anything.
+    // A single GOP over the limit gets trimmed.
+    let over_limit = |history: &History| {
+        (settings.max_bytes > 0 && history.bytes() as u64 > settings.max_bytes)
+            || (settings.max_buffers > 0
+                && history.len() + history.thinned_len() > settings.max_buffers as usize)
+    };
+    while over_limit(history) {
+        if !evict_oldest(history) {
+            history.pop_front();
+        }
+    }
+}
+
+// Evict the oldest data short of the last complete GOP: thinned keyframes
+// first, then leading delta units, then the oldest GOP.
+// Returns false if there was nothing left to evict.
+fn evict_oldest(history: &mut History) -> bool {
+    if history.thinned_len() > 0 {
+        history.pop_thinned();
+    } else if history.has_orphans() {
+        history.drop_orphans();
+    } else if history.gop_count() > 1 {
+        history.pop_gop();
+    } else {
+        return false;
+    }
+    true
+}
+
+// Sequence number of the oldest buffer held in any tier: the keyframes-only
+// tier is older than the spill ring, which is older than the RAM queue
+fn oldest_seq(state: &State) -> u64 {
+    state
+        .history
+        .thinned_front_seq()
+        .or_else(|| state.spill.as_ref().and_then(|spill| spill.front_seq()))
+        .unwrap_or_else(|| state.history.front_seq())
+}
+
+// Drop scheduled actions whose time has already passed. Called whenever the
+// valve changes state, so that an action meant for the previous state does
+// not act on the new one at the next buffer.
+fn expire_schedules(state: &mut State) {
+    let position = match state.position {
+        Some(position) => position,
+        None => return,
+    };
+    if let Some(at) = state.scheduled_open.take_if(|at| *at <= position) {
+        gst::debug!(CAT, "Dropping open scheduled at {}, already past", at);
+    }
+    if let Some(at) = state.scheduled_close.take_if(|at| *at <= position) {
+        gst::debug!(CAT, "Dropping close scheduled at {}, already past", at);
+    }
+}
+
+// Whether a dump would start on a keyframe. Spilled GOPs and the
+// keyframes-only tier always do.
+fn has_keyframe(state: &State) -> bool {
+    state.history.first_keyframe_index().is_some()
+        || state.history.thinned_len() > 0
+        || state.spill.as_ref().is_some_and(|spill| spill.front_timestamp().is_some())
+}
+
+fn is_delta_unit(buffer: &gst::BufferRef) -> bool {
+    buffer.flags().contains(gst::BufferFlags::DELTA_UNIT)
+}
+
+// Frame type from the bitstream if enabled and understood, otherwise from
+// the DELTA_UNIT flag
+fn frame_info(state: &State, settings: &Settings, buffer: &gst::BufferRef) -> FrameInfo {
+    let parsed = match (settings.keyframe_detection, state.codec) {
+        (KeyframeDetection::Bitstream, Some(codec)) => codec.inspect(buffer),
+        _ => None,
+    };
+    parsed.unwrap_or_else(|| FrameInfo {
+        is_keyframe: !is_delta_unit(buffer),
+        has_parameter_sets: false,
+    })
+}
+
+// Decoders cannot start on a keyframe without its parameter sets. If the
+// keyframe does not carry them in-band, insert the ones in effect for it.
+fn prepend_parameter_sets(codec: Option<Codec>, sets: &gst::Memory, buffer: &mut gst::Buffer) {
+    let codec = match codec {
+        Some(codec) => codec,
+        None => return,
+    };
+    if codec.parameter_sets(buffer).is_some() {
+        return;
+    }
+
+    gst::debug!(CAT, "Prepending cached parameter sets to the first dumped keyframe");
+    let aud_len = match codec.leading_aud_len(buffer) {
+        Some(aud_len) => aud_len,
+        None => {
+            buffer.make_mut().prepend_memory(sets.clone());
+            return;
+        }
+    };
+
+    // An access unit delimiter must stay in front: rebuild the first memory
+    // as delimiter, parameter sets, rest of the frame
+    let data = {
+        let (first, sets) = match (buffer.peek_memory(0).map_readable(), sets.map_readable()) {
+            (Ok(first), Ok(sets)) => (first, sets),
+            _ => return,
+        };
+        let mut data = Vec::with_capacity(first.len() + sets.len());
+        data.extend_from_slice(&first[..aud_len]);
+        data.extend_from_slice(&sets);
+        data.extend_from_slice(&first[aud_len..]);
+        data
+    };
+    buffer.make_mut().replace_memory(0, gst::Memory::from_mut_slice(data));
+}
+
+fn rebase_buffer(mut buffer: gst::Buffer, offset: gst::ClockTime) -> gst::Buffer {
+    {
+        let buffer = buffer.make_mut();
+        buffer.set_pts(buffer.pts().map(|pts| pts + offset));
+        buffer.set_dts(buffer.dts().map(|dts| dts + offset));
+    }
+    buffer
+}
+
+fn rebase_list(list: gst::BufferList, offset: gst::ClockTime) -> gst::BufferList {
+    let mut rebased = gst::BufferList::new_sized(list.len());
+    {
+        let rebased = rebased.get_mut().unwrap();
+        for buffer in list.iter_owned() {
+            rebased.add(rebase_buffer(buffer, offset));
+        }
+    }
+    rebased
+}
+
+// Time span between the oldest and the newest buffer across all tiers
+fn level_time(state: &State) -> gst::ClockTime {
+    let newest = match state.history.newest_timestamp() {
+        Some(newest) => newest,
+        None => return gst::ClockTime::ZERO,
+    };
+    match state.spill.as_ref().and_then(|spill| spill.front_timestamp()) {
+        Some(oldest) if state.history.thinned_len() == 0 => newest.saturating_sub(oldest),
+        _ => state.history.duration(),
+    }
+}
+
+// Bits of `PrerollValve::passthrough`: the fast path is enabled, and one
+// direct push in flight
+const PASSTHROUGH: usize = 1;
+const IN_FLIGHT: usize = 2;
+
+// A push on the pass-through fast path, counted while it runs
+struct InFlight<'a>(&'a AtomicUsize);
+
+impl Drop for InFlight<'_> {
+    fn drop(&mut self) {
+        self.0.fetch_sub(IN_FLIGHT, Ordering::Release);
+    }
+}
+
+// Groups dumped buffers into the buffer lists queued for the src pad task,
+// with the stored events in between, in stream order
+struct DumpLists<'a> {
+    pending: &'a mut PendingQueue,
+    list: gst::BufferList,
+    chunk_size: usize,
+    events: VecDeque<(u64, gst::Event)>,
+}
+
+impl<'a> DumpLists<'a> {
+    fn new(pending: &'a mut PendingQueue, chunk_size: usize, events: VecDeque<(u64, gst::Event)>) -> Self {
+        Self {
+            pending,
+            list: gst::BufferList::new(),
+            chunk_size,
+            events,
+        }
+    }
+
+    // `seq` is the stored sequence number of the buffer; the events stored
+    // in front of it go out first. `starts_chunk` marks a natural list
+    // boundary (a new GOP), only used when no explicit chunk size is set.
+    fn add(&mut self, buffer: gst::Buffer, seq: u64, starts_chunk: bool) {
+        while self.events.front().is_some_and(|(at, _)| *at <= seq) {
+            let (_, event) = self.events.pop_front().unwrap();
+            self.add_event(event);
+        }
+
+        let chunk_full = if self.chunk_size > 0 {
+            self.list.len() >= self.chunk_size
+        } else {
+            starts_chunk
+        };
+        if chunk_full && !self.list.is_empty() {
+            let full = std::mem::replace(&mut self.list, gst::BufferList::new());
+            self.pending.push_dump(Item::List(full));
+        }
+        self.list.get_mut().unwrap().add(buffer);
+    }
+
+    // Events go out between the lists, in stream order
+    fn add_event(&mut self, event: gst::Event) {
+        if !self.list.is_empty() {
+            let full = std::mem::replace(&mut self.list, gst::BufferList::new());
+            self.pending.push_dump(Item::List(full));
+        }
+        self.pending.push_dump(Item::Event(event));
+    }
+
+    // Events stored after the last buffer follow it
+    fn finish(mut self) {
+        for (_, event) in std::mem::take(&mut self.events) {
+            self.add_event(event);
+        }
+        if !self.list.is_empty() {
+            self.pending.push_dump(Item::List(self.list));
+        }
+    }
+}
+
+mod imp {
+    use super::*;
+    use glib::subclass::prelude::*;
+    use gst::subclass::prelude::*;
+
+    pub struct PrerollValve {
+        pub settings: SharedSettings,
+        pub state: Mutex<State>,
+        // Signalled whenever `State::pending` or `State::flushing` changes
+        pub cond: Condvar,
+        // Signalled when the src pad task made room in `State::pending`, or
+        // the streaming thread must stop waiting for it
+        pub space: Condvar,
+        // `PASSTHROUGH` is set by the src pad task once the valve is open
+        // and everything queued has gone out; the streaming thread then
+        // pushes directly. Only ever set with the state lock held and
+        // `pending` empty. The remaining bits count the direct pushes in
+        // flight in units of `IN_FLIGHT`, see `enter_passthrough()`.
+        pub passthrough: AtomicUsize,
+        // This instance's share of the process-wide memory budget
+        pub budget: Arc<BudgetSlot>,
+        pub srcpad: gst::Pad,
+        pub sinkpad: gst::Pad,
+    }
+
+    impl PrerollValve {
+        // Returns a guard if the streaming thread may push directly. The
+        // guard counts the push as in flight, so that the src pad task
+        // does not overtake it with data queued after the fast path was
+        // disabled (e.g. a dump after a quick close and reopen), see
+        // `wait_in_flight()`.
+        //
+        // Flag and count share one word, so announcing the push and
+        // checking the flag is a single read-modify-write: a push is
+        // either counted before `leave_passthrough()` or sees the flag
+        // cleared. The relaxed load only skips that while queueing.
+        fn enter_passthrough(&self) -> Option<InFlight<'_>> {
+            if self.passthrough.load(Ordering::Relaxed) & PASSTHROUGH == 0 {
+                return None;
+            }
+            let previous = self.passthrough.fetch_add(IN_FLIGHT, Ordering::Acquire);
+            let in_flight = InFlight(&self.passthrough);
+            (previous & PASSTHROUGH != 0).then_some(in_flight)
+        }
+
+        fn leave_passthrough(&self) {
+            self.passthrough.fetch_and(!PASSTHROUGH, Ordering::AcqRel);
+        }
+
+        // Wait for direct pushes that started before the fast path was
+        // disabled. Usually there are none; otherwise it is a single
+        // buffer downstream is still busy with.
+        fn wait_in_flight(&self) {
+            let mut spins = 0;
+            while self.passthrough.load(Ordering::Acquire) >= IN_FLIGHT {
+                if spins < 100 {
+                    std::thread::yield_now();
+                    spins += 1;
+                } else {
+                    std::thread::sleep(Duration::from_millis(1));
+                }
+            }
+        }
+
+        fn sink_chain(
+            &self,
+            _pad: &gst::Pad,
+            _element: &super::PrerollValve,
+            buffer: gst::Buffer,
+        ) -> Result<gst::FlowSuccess, gst::FlowError> {
+            if let Some(_in_flight) = self.enter_passthrough() {
+                return self.srcpad.push(buffer);
+            }
+
+            let mut state = self.state.lock().unwrap();
+            // Taken after the state lock: `open` only changes while it is held
+            let mut settings = self.settings.snapshot();
+
+            // Report errors from the src pad task (flushing, EOS, not-linked...)
+            state.flow?;
+
+            // Check debug property or GST log level
+            if settings.debug {
+                 gst::trace!(CAT, "Received buffer: pts={:?}, dts={:?}", buffer.pts(), buffer.dts());
+            }
+
+            if settings.open && settings.leaky == Leaky::No {
+                state = self.wait_for_space(state)?;
+                settings = self.settings.snapshot();
+            }
+
+            // Scheduled transitions happen right in front of the first
+            // buffer at or past their running time
+            let scheduled = self.run_schedule(&mut state, &settings, &buffer);
+            if scheduled.is_some() {
+                settings = self.settings.snapshot();
+            }
+            let mut notify_open = scheduled.is_some();
+
+            if settings.open {
+                let mut keep = true;
+                if state.awaiting_keyframe {
+                    if frame_info(&state, &settings, &buffer).is_keyframe {
+                        gst::info!(CAT, "Keyframe arrived, starting output");
+                        state.awaiting_keyframe = false;
+                    } else {
+                        keep = false;
+                    }
+                }
+
+                if keep && self.post_roll_done(&mut state, &settings, &buffer) {
+                    // Close in front of the keyframe so the clip ends on a
+                    // GOP boundary; the keyframe starts the new history
+                    gst::info!(CAT, "Post-roll done, closing valve");
+                    self.settings.open.store(false, Ordering::Relaxed);
+                    self.reset_open_state(&mut state);
+                    self.store_buffer(&mut state, &settings, buffer);
+                    notify_open = true;
+                } else if keep {
+                    if settings.record_while_open {
+                        self.store_buffer(&mut state, &settings, buffer.clone());
+                        state.history.mark_emitted();
+                    }
+
+                    // The history was already handed to the src pad task when
+                    // `open` was set, see `set_property()`.
+                    // Queue the current live buffer behind the dump; the src pad
+                    // task does the actual pushing so upstream is never stalled
+                    if let Some(buffer) = self.admit_live(&mut state, &settings, buffer) {
+                        let buffer = match state.rebase {
+                            Some(offset) => rebase_buffer(buffer, offset),
+                            None => buffer,
+                        };
+                        self.leave_passthrough();
+                        state.pending.push_live(Item::Buffer(buffer));
+                        self.cond.notify_one();
+                        self.update_budget(&state);
+                    }
+                }
+            } else {
+                self.store_buffer(&mut state, &settings, buffer);
+            }
+            drop(state);
+
+            if scheduled == Some(true) {
+                self.request_keyframe();
+            }
+            if notify_open {
+                self.obj().notify("open");
+            }
+            Ok(gst::FlowSuccess::Ok)
+        }
+
+        fn sink_chain_list(
+            &self,
+            _pad: &gst::Pad,
+            _element: &super::PrerollValve,
+            list: gst::BufferList,
+        ) -> Result<gst::FlowSuccess, gst::FlowError> {
+            if let Some(_in_flight) = self.enter_passthrough() {
+                return self.srcpad.push_list(list);
+            }
+
+            let mut state = self.state.lock().unwrap();
+            let mut settings = self.settings.snapshot();
+
+            state.flow?;
+
+            if settings.debug {
+                gst::trace!(CAT, "Received buffer list of {} buffers", list.len());
+            }
+
+            if settings.open && settings.leaky == Leaky::No {
+                state = self.wait_for_space(state)?;
+                settings = self.settings.snapshot();
+            }
+
+            let per_buffer = state.scheduled_open.is_some()
+                || state.scheduled_close.is_some()
+                || (settings.open
+                    && (state.post_roll.is_some()
+                        || (settings.leaky == Leaky::Upstream
+                            && (state.leaking || state.pending.is_full(&settings)))));
+            if per_buffer {
+                // The post-roll, a scheduled action or leaking may start
+                // anywhere in the list
+                drop(state);
+                for buffer in list.iter_owned() {
+                    self.sink_chain(_pad, _element, buffer)?;
+                }
+                return Ok(gst::FlowSuccess::Ok);
+            }
+
+            if settings.open {
+                let list = if state.awaiting_keyframe {
+                    let mut kept = gst::BufferList::new();
+                    for buffer in list.iter_owned() {
+                        if state.awaiting_keyframe
+                            && !frame_info(&state, &settings, &buffer).is_keyframe
+                        {
+                            continue;
+                        }
+                        state.awaiting_keyframe = false;
+                        kept.get_mut().unwrap().add(buffer);
+                    }
+                    if kept.is_empty() {
+                        return Ok(gst::FlowSuccess::Ok);
+                    }
+                    gst::info!(CAT, "Keyframe arrived, starting output");
+                    kept
+                } else {
+                    list
+                };
+                if settings.record_while_open {
+                    for buffer in list.iter_owned() {
+                        self.store_buffer(&mut state, &settings, buffer);
+                    }
+                    state.history.mark_emitted();
+                }
+                let list = match state.rebase {
+                    Some(offset) => rebase_list(list, offset),
+                    None => list,
+                };
+
+                self.leave_passthrough();
+                state.pending.push_live(Item::List(list));
+                self.cond.notify_one();
+                self.update_budget(&state);
+            } else {
+                for buffer in list.iter_owned() {
+                    self.store_buffer(&mut state, &settings, buffer);
+                }
+            }
+            Ok(gst::FlowSuccess::Ok)
+        }
+
+        // Valve is closed (default): store incoming buffers
+        fn store_buffer(&self, state: &mut State, settings: &Settings, buffer: gst::Buffer) {
+            // Identify keyframe
+            // GST_BUFFER_FLAG_DELTA_UNIT == FALSE means keyframe (usually),
+            // unless the bitstream itself is inspected
+            let info = frame_info(state, settings, &buffer);
+            let is_keyframe = info.is_keyframe;
+            if settings.debug && info.has_parameter_sets {
+                gst::trace!(CAT, "Buffer carries in-band parameter sets");
+            }
+
+            // Keep the parameter sets of each GOP around, for a dump starting
+            // on a keyframe without them; keyframes are rare enough for this
+            // to cost next to nothing
+            if is_keyframe {
+                if let Some(sets) = state.codec.and_then(|codec| codec.parameter_sets(&buffer)) {
+                    state.history.push_parameter_sets(Some(gst::Memory::from_mut_slice(sets)));
+                }
+            }
+            let timestamp = self.retention_timestamp(state, settings, &buffer);
+
+            // Copy the payload into our own memory so the upstream buffer
+            // goes back to its pool right away
+            let buffer = match state.arena.as_mut() {
+                Some(arena) => arena.copy(&buffer),
+                None => buffer,
+            };
+
+            let stored = StoredBuffer {
+                buffer: buffer, // ownership moved to struct
+                seq: state.history.next_seq(),
+                timestamp,
+                is_keyframe,
+            };
+            
+            state.history.push(stored);
+
+            // Prune old buffers
+            // "current_timestamp - buffer.timestamp <= max_history", relative
+            // to the stream head
+            prune_history(&mut state.history, state.spill.as_mut(), settings, timestamp);
+
+            // Give memory back if the process-wide budget asked for it
+            let shed = self.budget.take_shed() as usize;
+            if shed > 0 {
+                let target = state.history.bytes().saturating_sub(shed);
+                while state.history.bytes() > target && evict_oldest(&mut state.history) {}
+                gst::debug!(CAT, "Shed history down to {} bytes for the global budget",
+                    state.history.bytes()
+                );
+            }
+
+            // Events and parameter sets stored in front of what is left only
+            // matter as state
+            let oldest = oldest_seq(state);
+            state.history.collapse_metadata(oldest);
+            self.update_budget(state);
+        }
+
+        // Block while the live data queued for output is over the
+        // `max-pending-*` limits, until the src pad task made room or the
+        // valve closed. Only used when not leaky.
+        // Returns the src pad task's error if it stopped meanwhile.
+        fn wait_for_space<'a>(
+            &'a self,
+            mut state: std::sync::MutexGuard<'a, State>,
+        ) -> Result<std::sync::MutexGuard<'a, State>, gst::FlowError> {
+            loop {
+                let settings = self.settings.snapshot();
+                if !settings.open || settings.leaky != Leaky::No || !state.pending.is_full(&settings) {
+                    state.waiting_for_space = false;
+                    return Ok(state);
+                }
+                if !state.waiting_for_space {
+                    gst::debug!(CAT, "Pending queue full, blocking upstream");
+                    state.waiting_for_space = true;
+                }
+                state = self.space.wait(state).unwrap();
+                if let Err(err) = state.flow {
+                    state.waiting_for_space = false;
+                    return Err(err);
+                }
+            }
+        }
+
+        // In leaky mode, drop live data while the pending queue is full, and
+        // after that everything up to the next keyframe that fits. The
+        // keyframe output resumes at is marked DISCONT.
+        // Returns the buffer if it is to be queued.
+        fn admit_live(&self, state: &mut State, settings: &Settings, mut buffer: gst::Buffer) -> Option<gst::Buffer> {
+            if settings.leaky != Leaky::Upstream {
+                return Some(buffer);
+            }
+            let full = state.pending.is_full(settings);
+            if !full && !state.leaking {
+                return Some(buffer);
+            }
+            if !full && frame_info(state, settings, &buffer).is_keyframe {
+                gst::info!(CAT, "Pending queue has room again, resuming at a keyframe");
+                state.leaking = false;
+                buffer.make_mut().set_flags(gst::BufferFlags::DISCONT);
+                return Some(buffer);
+            }
+            if !state.leaking {
+                gst::warning!(CAT, "Pending queue full, dropping live data up to the next keyframe");
+                state.leaking = true;
+            }
+            // The rest of the GOP must not slip out through the fast path
+            // once the queue has drained
+            self.leave_passthrough();
+            None
+        }
+
+        // Time used for retention, GOP indexing and dump selection. Buffers
+        // without a usable timestamp count as arriving with the newest one.
+        fn retention_timestamp(
+            &self,
+            state: &State,
+            settings: &Settings,
+            buffer: &gst::BufferRef,
+        ) -> gst::ClockTime {
+            let timestamp = match settings.retention_time {
+                RetentionTime::ArrivalTime => self.obj().current_running_time(),
+                RetentionTime::RunningTime => {
+                    // Decode order is monotonic, presentation order is not
+                    // with B-frames. Without a DTS, PTS is clamped to the
+                    // newest time so reordered frames never look older.
+                    let dts = buffer.dts().and_then(|dts| state.segment.to_running_time(dts));
+                    dts.or_else(|| {
+                        let pts = buffer.pts().and_then(|pts| state.segment.to_running_time(pts))?;
+                        Some(state.history.newest_timestamp().map_or(pts, |newest| pts.max(newest)))
+                    })
+                }
+            };
+            timestamp
+                .or_else(|| state.history.newest_timestamp())
+                .unwrap_or(gst::ClockTime::ZERO)
+        }
+
+        // Account a live buffer to the post-roll. True if the valve should
+        // close in front of it: every enabled limit has been reached and
+        // this is a keyframe.
+        fn post_roll_done(&self, state: &mut State, settings: &Settings, buffer: &gst::BufferRef) -> bool {
+            if state.post_roll.is_none() {
+                return false;
+            }
+            let ts = self.retention_timestamp(state, settings, buffer);
+            let is_keyframe = frame_info(state, settings, buffer).is_keyframe;
+
+            let post_roll = state.post_roll.as_mut().unwrap();
+            let start = *post_roll.start.get_or_insert(ts);
+            if is_keyframe {
+                post_roll.keyframes += 1;
+            }
+            is_keyframe
+                && (settings.post_roll == 0
+                    || ts.saturating_sub(start) >= gst::ClockTime::from_mseconds(settings.post_roll))
+                && (settings.post_roll_gops == 0 || post_roll.keyframes > settings.post_roll_gops)
+        }
+
+        // Open the valve: set up the per-open state and hand the history to
+        // the src pad task. `settings.open` must already be set. With a
+        // trigger time, the dump starts at the keyframe covering max-history
+        // before it.
+        // Returns whether a keyframe should be requested upstream, which
+        // must happen without the state lock held.
+        fn open_valve(&self, state: &mut State, trigger: Option<gst::ClockTime>) -> bool {
+            expire_schedules(state);
+            state.opened_at = Some(Instant::now());
+            let snapshot = self.settings.snapshot();
+            if snapshot.post_roll > 0 || snapshot.post_roll_gops > 0 {
+                state.post_roll = Some(PostRoll::default());
+            }
+            // Resuming a continuous recording needs no keyframe
+            let resumes = snapshot.record_while_open && state.history.unemitted_index().is_some();
+            let request_keyframe = snapshot.keyframe_on_open != KeyframeOnOpen::None
+                && !resumes
+                && !has_keyframe(state);
+            if request_keyframe && snapshot.keyframe_on_open == KeyframeOnOpen::Wait {
+                // Nothing decodable to dump; drop it and wait for
+                // the requested keyframe. The stored sticky events
+                // still go out.
+                state.awaiting_keyframe = true;
+                state.history.clear();
+            }
+            let preroll_from = trigger
+                .map(|trigger| trigger.saturating_sub(gst::ClockTime::from_mseconds(snapshot.max_history)));
+            self.dump_history(state, &snapshot, preroll_from);
+            request_keyframe
+        }
+
+        fn request_keyframe(&self) {
+            gst::info!(CAT, "No keyframe in history, requesting one upstream");
+            let event = gst_video::UpstreamForceKeyUnitEvent::builder()
+                .all_headers(true)
+                .build();
+            if !self.sinkpad.push_event(event) {
+                gst::debug!(CAT, "Upstream did not handle the keyframe request");
+            }
+        }
+
+        // Fire the scheduled actions whose running time `buffer` reached, in
+        // front of it and in time order. An open while already open is a
+        // retrigger; a close while already closed is dropped.
+        // Returns None if the valve did not change state, otherwise whether
+        // a keyframe should be requested upstream.
+        fn run_schedule(
+            &self,
+            state: &mut State,
+            settings: &Settings,
+            buffer: &gst::BufferRef,
+        ) -> Option<bool> {
+            // Presentation time, which is what triggers refer to
+            let ts = match settings.retention_time {
+                RetentionTime::RunningTime => buffer.pts().and_then(|pts| state.segment.to_running_time(pts)),
+                RetentionTime::ArrivalTime => None,
+            }
+            .unwrap_or_else(|| self.retention_timestamp(state, settings, buffer));
+
+            let mut fired = None;
+            let mut open = settings.open;
+            loop {
+                let close = state.scheduled_close.filter(|at| *at <= ts).map(|at| (at, false));
+                let opening = state.scheduled_open.filter(|at| *at <= ts).map(|at| (at, true));
+                let (at, is_open) = match close.into_iter().chain(opening).min_by_key(|(at, _)| *at) {
+                    Some(due) => due,
+                    None => break,
+                };
+
+                if is_open {
+                    state.scheduled_open = None;
+                    if open {
+                        gst::info!(CAT, "Retriggered at scheduled running time {}", at);
+                        self.retrigger(state);
+                    } else {
+                        gst::info!(CAT, "Opening at scheduled running time {}", at);
+                        self.settings.open.store(true, Ordering::Relaxed);
+                        fired = Some(self.open_valve(state, Some(at)));
+                        open = true;
+                    }
+                } else {
+                    state.scheduled_close = None;
+                    if open {
+                        gst::info!(CAT, "Closing at scheduled running time {}", at);
+                        self.settings.open.store(false, Ordering::Relaxed);
+                        self.reset_open_state(state);
+                        fired = Some(false);
+                        open = false;
+                    } else {
+                        gst::debug!(CAT, "Dropping close scheduled at {}, already closed", at);
+                    }
+                }
+            }
+            state.position = Some(ts);
+            fired
+        }
+
+        // Another open while open restarts the post-roll
+        fn retrigger(&self, state: &mut State) {
+            if let Some(post_roll) = state.post_roll.as_mut() {
+                gst::debug!(CAT, "Retriggered, extending post-roll");
+                *post_roll = PostRoll::default();
+            }
+        }
+
+        // Schedule an open or close requested by a trigger event
+        fn handle_trigger(&self, event: &gst::EventRef) {
+            let s = match event.structure() {
+                Some(s) => s,
+                None => return,
+            };
+            let open = match s.get::<&str>("action") {
+                Ok("close") => false,
+                Ok("open") | Err(..) => true,
+                Ok(action) => {
+                    gst::warning!(CAT, "Unknown trigger action {}", action);
+                    return;
+                }
+            };
+            // Without a running time the trigger applies to the next buffer
+            let at = s
+                .get::<u64>("running-time")
+                .map(gst::ClockTime::from_nseconds)
+                .unwrap_or(gst::ClockTime::ZERO);
+
+            gst::debug!(CAT, "Trigger event: {} at running time {}",
+                if open { "open" } else { "close" },
+                at
+            );
+            let mut state = self.state.lock().unwrap();
+            if open {
+                state.scheduled_open = Some(at);
+            } else {
+                state.scheduled_close = Some(at);
+            }
+            // Scheduled actions are checked on the locked path
+            self.leave_passthrough();
+        }
+
+        // Drop everything that only lives while the valve is open
+        fn reset_open_state(&self, state: &mut State) {
+            expire_schedules(state);
+            self.leave_passthrough();
+            // Closed, so nothing is queued anymore: stop blocking upstream
+            self.space.notify_all();
+            state.leaking = false;
+            state.awaiting_keyframe = false;
+            state.rebase = None;
+            state.post_roll = None;
+            // The `segment` output offset ends with the open period, after
+            // whatever is still queued from it
+            if state.src_offset != 0 {
+                state.src_offset = 0;
+                state.pending.push_dump(Item::Offset(0));
+                self.cond.notify_one();
+            }
+        }
+
+        // Publish the in-RAM history and output queue size to the
+        // process-wide budget
+        fn update_budget(&self, state: &State) {
+            self.budget.set_used(state.history.bytes() as u64 + state.pending.bytes());
+        }
+
+        // Move the history, starting at its oldest keyframe, to the pending
+        // queue and wake up the src pad task
+        fn dump_history(&self, state: &mut State, settings: &Settings, preroll_from: Option<gst::ClockTime>) {
+            if state.history.is_empty() {
+                gst::info!(CAT, "Valve opened with an empty history");
+            } else {
+                gst::info!(CAT, "Valve opened. Dumping {} buffered frames ({} keyframes-only).",
+                    state.history.len(),
+                    state.history.thinned_len()
+                );
+            }
+
+            // With continuous recording the history is kept, and a reopen
+            // resumes right after the last buffer sent if the history still
+            // reaches back to it. Downstream then sees an unbroken stream and
+            // needs no keyframe; everything older was already sent.
+            let keep = settings.record_while_open;
+            let resume = if keep { state.history.unemitted_index() } else { None };
+            if resume.is_some() {
+                drop(state.history.take_thinned());
+                if let Some(spill) = state.spill.as_mut() {
+                    spill.clear();
+                }
+            }
+
+            // Spilled history comes back from the ring file zero-copy, from
+            // its oldest keyframe on
+            let spilled = state.spill.as_mut().map(|spill| spill.take_all()).unwrap_or_default();
+            if !spilled.is_empty() {
+                gst::info!(CAT, "Dumping {} frames spilled to disk", spilled.len());
+            }
+
+            // Start from the oldest keyframe to maximize preroll; the
+            // decoder needs a keyframe to start from. The in-RAM history
+            // continues the spilled one, so in that case it goes out whole.
+            let idx = if let Some(idx) = resume {
+                gst::info!(CAT, "Resuming after the last emitted buffer");
+                idx
+            } else if !spilled.is_empty() {
+                0
+            } else if let Some(idx) = preroll_from.and_then(|from| state.history.keyframe_index_before(from)) {
+                // Triggered at a known time: start at the GOP covering
+                // max-history before it. Older keyframes are out of range.
+                if Some(idx) != state.history.first_keyframe_index() {
+                    drop(state.history.take_thinned());
+                }
+                idx
+            } else {
+                state.history.first_keyframe_index().unwrap_or_else(|| {
+                    if state.history.len() > 0 {
+                        gst::warning!(CAT, "No keyframe found in buffer, dumping from start");
+                    }
+                    0
+                })
+            };
+            
+            let frames_to_dump = state.history.len() - idx;
+            gst::info!(CAT, "Starting dump from index {} (is_keyframe={}), dumping {} frames", 
+                idx, 
+                state.history.get(idx).map(|b| b.is_keyframe).unwrap_or(false),
+                frames_to_dump
+            );
+            let full_rate_start = spilled
+                .first()
+                .or(state.history.get(idx))
+                .map(|stored| stored.timestamp);
+
+            // Sticky events stored with the history, across all tiers: the
+            // ones applying to the first dumped buffer go first, the others
+            // in between the buffers they precede
+            let start_seq = state
+                .history
+                .thinned_front_seq()
+                .or(spilled.first().map(|stored| stored.seq))
+                .unwrap_or(state.history.front_seq() + idx as u64);
+            let events = if keep {
+                state.history.events_from(start_seq)
+            } else {
+                state.history.take_events(start_seq)
+            };
+
+            // Move the output onto the current running time so live-synced
+            // sinks do not drop the dump as late. The same shift applies to
+            // the live data that follows, until the valve closes. The shift
+            // is relative to the first buffer's PTS as a running time in the
+            // segment it was stored with; the retention timestamp may be an
+            // arrival time or a DTS.
+            let first = state
+                .history
+                .thinned_front()
+                .or(spilled.first())
+                .or(state.history.get(idx));
+            let first_ts = first.map(|stored| {
+                let segment = events
+                    .iter()
+                    .take_while(|(seq, _)| *seq <= stored.seq)
+                    .filter_map(|(_, event)| match event.view() {
+                        gst::EventView::Segment(segment) => {
+                            segment.segment().downcast_ref::<gst::ClockTime>().cloned()
+                        }
+                        _ => None,
+                    })
+                    .last()
+                    .unwrap_or_else(|| state.segment.clone());
+                let buffer = &stored.buffer;
+                buffer
+                    .pts()
+                    .or(buffer.dts())
+                    .and_then(|ts| segment.to_running_time(ts))
+                    .unwrap_or(stored.timestamp)
+            });
+            let offset = match (settings.output_timestamps, first_ts, self.obj().current_running_time()) {
+                (OutputTimestamps::Original, ..) => gst::ClockTime::ZERO,
+                (_, Some(first_ts), Some(now)) => now.saturating_sub(first_ts),
+                _ => gst::ClockTime::ZERO,
+            };
+            if offset > gst::ClockTime::ZERO {
+                gst::info!(CAT, "Shifting output by {} ({:?})", offset, settings.output_timestamps);
+            }
+            state.rebase = (settings.output_timestamps == OutputTimestamps::Rebase).then_some(offset);
+            let segment_offset = match settings.output_timestamps {
+                OutputTimestamps::Segment => offset.nseconds() as i64,
+                _ => 0,
+            };
+            // Changed by the src pad task, so it applies from the first
+            // dumped buffer on and not to data still queued in front of it
+            if segment_offset != state.src_offset {
+                state.src_offset = segment_offset;
+                state.pending.push_dump(Item::Offset(segment_offset));
+            }
+            let rebase = state.rebase;
+
+            // Hand the history over in bulk: one buffer list per GOP, or per
+            // `dump-chunk-size` buffers if set
+            let codec = state.codec;
+            let mut parameter_sets = state.history.parameter_sets_for(start_seq);
+            let mut lists = DumpLists::new(&mut state.pending, settings.dump_chunk_size as usize, events);
+
+            // Keyframes-only tier first, as a time-lapse. Every keyframe is
+            // discontinuous with the previous one and lasts until the next
+            let mut thinned = state.history.take_thinned().peekable();
+            // The first dumped buffer is discontinuous with whatever went
+            // out before, unless it resumes right where that stopped
+            let mut discont = resume.is_none();
+            let mut first = true;
+            while let Some(stored) = thinned.next() {
+                let next_ts = thinned.peek().map(|next| next.timestamp).or(full_rate_start);
+                let mut buffer = stored.buffer;
+                if let Some(sets) = parameter_sets.take() {
+                    prepend_parameter_sets(codec, &sets, &mut buffer);
+                }
+                {
+                    let buffer = buffer.make_mut();
+                    buffer.set_flags(gst::BufferFlags::DISCONT);
+                    if let Some(next_ts) = next_ts {
+                        buffer.set_duration(next_ts.saturating_sub(stored.timestamp));
+                    }
+                }
+                if let Some(offset) = rebase {
+                    buffer = rebase_buffer(buffer, offset);
+                }
+                if settings.debug {
+                    gst::trace!(CAT, "Queueing thinned keyframe pts={:?}", buffer.pts());
+                }
+                lists.add(buffer, stored.seq, first);
+                first = false;
+                discont = true;
+            }
+            drop(thinned);
+
+            // Buffers are moved out of the history rather than cloned, so
+            // downstream gets the only reference and can modify them in place
+            // (unless the history is kept, then they are shared)
+            let ram: Box<dyn Iterator<Item = StoredBuffer> + '_> = if keep {
+                Box::new(state.history.iter_from(idx).cloned())
+            } else {
+                Box::new(state.history.take_from(idx))
+            };
+            for stored in spilled.into_iter().chain(ram) {
+                let mut buffer = stored.buffer;
+                if let Some(sets) = parameter_sets.take() {
+                    if stored.is_keyframe {
+                        prepend_parameter_sets(codec, &sets, &mut buffer);
+                    }
+                }
+                if discont {
+                    buffer.make_mut().set_flags(gst::BufferFlags::DISCONT);
+                    discont = false;
+                }
+                if let Some(offset) = rebase {
+                    buffer = rebase_buffer(buffer, offset);
+                }
+                if settings.debug {
+                    gst::trace!(CAT, "Queueing stored buffer pts={:?}", buffer.pts());
+                }
+                lists.add(buffer, stored.seq, stored.is_keyframe);
+            }
+            lists.finish();
+            if keep {
+                state.history.mark_emitted();
+            }
+
+            // Everything queued from here on, live buffers included, goes
+            // out paced until the queue has drained
+            if (settings.dump_rate > 0 || settings.dump_speed > 0.0) && !state.pending.is_empty() {
+                state.pacing = Some(Pacing::new(settings));
+            }
+            self.cond.notify_one();
+            self.update_budget(state);
+        }
+
+        fn sink_event(
+            &self,
+            _pad: &gst::Pad,
+            _element: &super::PrerollValve,
+            event: gst::Event,
+        ) -> bool {
+            // Forward all incoming events (e.g., CAPS/EOS/FLUSH) to src pad to
+            // keep negotiation working. Serialized events go through the
+            // pending queue to stay in order with the buffers; sticky ones
+            // are stored with the history while closed.
+            if event.structure().is_some_and(|s| s.name() == TRIGGER_EVENT) {
+                self.handle_trigger(&event);
+                return true;
+            }
+
+            match event.view() {
+                gst::EventView::Caps(caps) => {
+                    let codec = Codec::from_caps(caps.caps());
+                    gst::debug!(CAT, "Bitstream keyframe detection codec: {:?}", codec);
+                    let mut state = self.state.lock().unwrap();
+                    if state.codec != codec {
+                        state.history.push_parameter_sets(None);
+                    }
+                    state.codec = codec;
+                }
+                gst::EventView::Segment(segment) => {
+                    let segment = match segment.segment().downcast_ref::<gst::ClockTime>() {
+                        Some(segment) => segment.clone(),
+                        None => {
+                            gst::warning!(CAT, "Non-TIME segment, retention uses raw timestamps");
+                            gst::FormattedSegment::new()
+                        }
+                    };
+                    self.state.lock().unwrap().segment = segment;
+                }
+                _ => {}
+            }
+
+            match event.view() {
+                gst::EventView::FlushStart(..) => {
+                    {
+                        let mut state = self.state.lock().unwrap();
+                        self.leave_passthrough();
+                        state.flushing = true;
+                        state.flow = Err(gst::FlowError::Flushing);
+                        state.pacing = None;
+                        if let Some(clock_id) = state.clock_wait.take() {
+                            clock_id.unschedule();
+                        }
+                    }
+                    self.cond.notify_one();
+                    self.space.notify_all();
+                    let ret = self.srcpad.push_event(event);
+                    let _ = self.srcpad.pause_task();
+                    ret
+                }
+                gst::EventView::FlushStop(..) => {
+                    {
+                        let mut state = self.state.lock().unwrap();
+                        state.pending.clear();
+                        // The task is paused, apply what the dropped items
+                        // would have left
+                        self.srcpad.set_offset(state.src_offset);
+                        state.leaking = false;
+                        state.history.clear();
+                        if let Some(spill) = state.spill.as_mut() {
+                            spill.clear();
+                        }
+                        self.update_budget(&state);
+                    }
+                    let ret = self.srcpad.push_event(event);
+                    if let Err(err) = self.start_task() {
+                        err.log();
+                        return false;
+                    }
+                    ret
+                }
+                _ if event.is_serialized() => {
+                    if let Some(_in_flight) = self.enter_passthrough() {
+                        return self.srcpad.push_event(event);
+                    }
+
+                    let mut state = self.state.lock().unwrap();
+                    if state.flushing {
+                        return false;
+                    }
 
-struct State {
-    queue: VecDeque<StoredBuffer>,
-}
+                    // While closed, sticky events belong to the buffers
+                    // that follow them and go out with those on dump
+                    let is_eos = matches!(event.view(), gst::EventView::Eos(..));
+                    if event.is_sticky() && !is_eos {
+                        if !self.settings.open.load(Ordering::Relaxed) {
+                            state.history.push_event(event);
+                            return true;
+                        }
+                        // Recorded while open as well, for the buffers that
+                        // follow them in the history, and forwarded
+                        if self.settings.record_while_open.load(Ordering::Relaxed) {
+                            state.history.push_event(event.clone());
+                        }
+                    }
 
-impl Default for State {
-    fn default() -> Self {
-        Self {
-            queue: VecDeque::new(),
+                    self.leave_passthrough();
+                    state.pending.push_live(Item::Event(event));
+                    self.cond.notify_one();
+                    true
+                }
+                _ => self.srcpad.push_event(event),
+            }
         }
-    }
-}
 
-mod imp {
-    use super::*;
-    use glib::subclass::prelude::*;
-    use gst::subclass::prelude::*;
+        fn sink_query(
+            &self,
+            pad: &gst::Pad,
+            _element: &super::PrerollValve,
+            query: &mut gst::QueryRef,
+        ) -> bool {
+            let is_allocation = matches!(query.view(), gst::QueryView::Allocation(..));
+            if !gst::Pad::query_default(pad, Some(&*self.obj()), query) {
+                return false;
+            }
 
-    pub struct PrerollValve {
-        pub settings: Mutex<Settings>,
-        pub state: Mutex<State>,
-        pub srcpad: gst::Pad,
-        pub sinkpad: gst::Pad,
-    }
+            if is_allocation {
+                if let gst::QueryViewMut::Allocation(q) = query.view_mut() {
+                    self.adjust_allocation(q);
+                }
+            }
+            true
+        }
 
-    impl PrerollValve {
-        fn sink_chain(
+        // Upstream pools must have room for everything the history holds on
+        // to, unless payloads are copied out on store
+        fn adjust_allocation(&self, q: &mut gst::query::Allocation) {
+            let settings = self.settings.snapshot();
+            if settings.copy_on_store {
+                return;
+            }
+
+            let held = if settings.max_buffers > 0 {
+                settings.max_buffers
+            } else {
+                let (caps, _) = q.get();
+                let framerate = caps
+                    .and_then(|caps| caps.structure(0))
+                    .and_then(|s| s.get::<gst::Fraction>("framerate").ok())
+                    .filter(|fps| fps.numer() > 0 && fps.denom() > 0);
+                match framerate {
+                    Some(fps) => (settings.max_history * fps.numer() as u64)
+                        .div_ceil(1000 * fps.denom() as u64) as u32,
+                    None => return,
+                }
+            };
+
+            let pools: Vec<_> = q.allocation_pools().into_iter().collect();
+            for (idx, (pool, size, min, max)) in pools.into_iter().enumerate() {
+                let min = min.saturating_add(held);
+                let max = if max > 0 { max.max(min) } else { 0 };
+                gst::debug!(CAT, "Raising allocation pool {} to min {} buffers", idx, min);
+                q.set_nth_allocation_pool(idx as u32, pool.as_ref(), size, min, max);
+            }
+        }
+
+        fn src_event(
             &self,
             _pad: &gst::Pad,
             _element: &super::PrerollValve,
-            buffer: gst::Buffer,
-        ) -> Result<gst::FlowSuccess, gst::FlowError> {
-            let settings = self.settings.lock().unwrap();
-            let mut state = self.state.lock().unwrap();
+            event: gst::Event,
+        ) -> bool {
+            // Upstream-directed events (QoS, FORCE_KEY_UNIT, RECONFIGURE,
+            // SEEK...) go straight to the producer
+            if event.structure().is_some_and(|s| s.name() == TRIGGER_EVENT) {
+                self.handle_trigger(&event);
+                return true;
+            }
 
-            // Check debug property or GST log level
-            if settings.debug {
-                 gst::trace!(CAT, "Received buffer: pts={:?}, dts={:?}", buffer.pts(), buffer.dts());
+            // Downstream got linked again after the task paused on
+            // not-linked: resume it, like queue does
+            if let gst::EventView::Reconfigure(..) = event.view() {
+                let restart = {
+                    let mut state = self.state.lock().unwrap();
+                    let not_linked = !state.flushing && state.flow == Err(gst::FlowError::NotLinked);
+                    if not_linked {
+                        state.flow = Ok(gst::FlowSuccess::Ok);
+                    }
+                    not_linked
+                };
+                if restart {
+                    gst::debug!(CAT, "Reconfigured while not linked, restarting the src pad task");
+                    if let Err(err) = self.start_src_loop() {
+                        err.log();
+                    }
+                }
             }
+            self.sinkpad.push_event(event)
+        }
 
-            if settings.open {
-                // If we have data in queue, we must dump it first
-                // This happens on the transition from closed -> open
-                // Since we are in the chain function, we are serialized with upstream
-                if !state.queue.is_empty() {
-                    gst::info!(CAT, "Valve opened. Dumping {} buffered frames.", state.queue.len());
-                    
-                    // Find first keyframe index
-                    let mut start_index = None;
-                    // Search forwards for the first keyframe to maximize preroll
-                    // We need to start from a keyframe so the decoder can decode
-                    for (i, stored) in state.queue.iter().enumerate() {
-                        if stored.is_keyframe {
-                            start_index = Some(i);
-                            break;
-                        }
+        fn src_query(
+            &self,
+            pad: &gst::Pad,
+            _element: &super::PrerollValve,
+            query: &mut gst::QueryRef,
+        ) -> bool {
+            match query.view_mut() {
+                gst::QueryViewMut::Latency(q) => {
+                    let mut peer_query = gst::query::Latency::new();
+                    if !self.sinkpad.peer_query(&mut peer_query) {
+                        return false;
                     }
-                    
-                    // Use first keyframe if found, otherwise dump from start
-                    let idx = start_index.unwrap_or_else(|| {
-                        gst::warning!(CAT, "No keyframe found in buffer, dumping from start");
-                        0
-                    });
-                    
-                    let frames_to_dump = state.queue.len() - idx;
-                    gst::info!(CAT, "Starting dump from index {} (is_keyframe={}), dumping {} frames", 
-                        idx, 
-                        state.queue.get(idx).map(|b| b.is_keyframe).unwrap_or(false),
-                        frames_to_dump
+                    let (live, min, max) = peer_query.result();
+
+                    // Pass-through adds nothing. With the original
+                    // timestamps, though, a dump releases data up to the
+                    // whole retained window late, and live sinks size their
+                    // delay from the minimum; with `rebase` / `segment` the
+                    // dump lands on the current running time instead.
+                    let settings = self.settings.snapshot();
+                    let (min, max) = match settings.output_timestamps {
+                        OutputTimestamps::Original => {
+                            let window = gst::ClockTime::from_mseconds(
+                                settings.max_history.max(settings.keyframe_history),
+                            );
+                            let min = min + window;
+                            // Only as far as needed to stay consistent
+                            (min, max.map(|max| max.max(min)))
+                        }
+                        _ => (min, max),
+                    };
+                    gst::debug!(CAT, "Reporting latency: live {}, min {}, max {}",
+                        live, min, max.display()
                     );
+                    q.set(live, min, max);
+                    true
+                }
+                _ => gst::Pad::query_default(pad, Some(&*self.obj()), query),
+            }
+        }
+
+        fn iterate_internal_links(&self, pad: &gst::Pad) -> gst::Iterator<gst::Pad> {
+            if pad == &self.srcpad {
+                gst::Iterator::from_vec(vec![self.sinkpad.clone()])
+            } else {
+                gst::Iterator::from_vec(vec![self.srcpad.clone()])
+            }
+        }
 
-                    // Dump buffers
-                    for i in idx..state.queue.len() {
-                        if let Some(stored) = state.queue.get(i) {
-                             if settings.debug {
-                                gst::trace!(CAT, "Pushing stored buffer pts={:?}", stored.buffer.pts());
-                            }
-                            let buf_to_push = stored.buffer.clone();
-                            if let Err(e) = self.srcpad.push(buf_to_push) {
-                                gst::error!(CAT, "Failed to push stored buffer: {:?}", e);
-                                state.queue.clear();
-                                return Err(e);
-                            }
+        fn src_loop(&self) {
+            let mut state = self.state.lock().unwrap();
+            let item = loop {
+                if state.flushing {
+                    drop(state);
+                    let _ = self.srcpad.pause_task();
+                    return;
+                }
+                if let Some(item) = state.pending.pop_front() {
+                    if state.waiting_for_space {
+                        self.space.notify_all();
+                    }
+                    self.update_budget(&state);
+                    if let Item::Buffer(..) | Item::List(..) = item {
+                        if let Some(opened_at) = state.opened_at.take() {
+                            let latency = opened_at.elapsed();
+                            gst::info!(CAT, "First buffer after open pushed after {:?}", latency);
+                            state.open_latency = Some(latency);
                         }
                     }
-                    state.queue.clear();
+                    break item;
                 }
+                state = self.cond.wait(state).unwrap();
+            };
 
-                // Forward the current live buffer
-                drop(state);
-                drop(settings);
-                self.srcpad.push(buffer)
-            } else {
-                // Valve is closed (default)
-                // Store incoming buffers
-                
-                // Identify keyframe
-                // GST_BUFFER_FLAG_DELTA_UNIT == FALSE means keyframe (usually)
-                let is_keyframe = !buffer.flags().contains(gst::BufferFlags::DELTA_UNIT);
-                let pts = buffer.pts().or_else(|| buffer.dts()).unwrap_or(gst::ClockTime::ZERO);
-
-                let stored = StoredBuffer {
-                    buffer: buffer, // ownership moved to struct
-                    timestamp: pts,
-                    is_keyframe,
-                };
-                
-                state.queue.push_back(stored);
-
-                // Prune old buffers
-                let max_history = gst::ClockTime::from_mseconds(settings.max_history);
-                // We use the timestamp of the *latest* buffer (pts) as reference current time?
-                // Or system time?
-                // "current_timestamp - buffer.timestamp <= max_history". 
-                // Usually this implies relative to the stream head.
-                let current_ts = pts;
-                
-                while let Some(front) = state.queue.front() {
-                    if current_ts > front.timestamp && (current_ts - front.timestamp) > max_history {
-                        state.queue.pop_front();
+            if state.pacing.is_some() {
+                if let Some((ts, size)) = item.pacing_info() {
+                    match self.wait_paced(state, ts, size) {
+                        Some(guard) => state = guard,
+                        None => return,
+                    }
+                }
+            }
+            drop(state);
+
+            self.wait_in_flight();
+            let res = match item {
+                Item::Buffer(buffer) => self.srcpad.push(buffer),
+                Item::List(list) => self.srcpad.push_list(list),
+                Item::Offset(offset) => {
+                    self.srcpad.set_offset(offset);
+                    Ok(gst::FlowSuccess::Ok)
+                }
+                Item::Event(event) => {
+                    let is_eos = matches!(event.view(), gst::EventView::Eos(..));
+                    self.srcpad.push_event(event);
+                    if is_eos {
+                        Err(gst::FlowError::Eos)
                     } else {
-                        break;
+                        Ok(gst::FlowSuccess::Ok)
                     }
                 }
-                
-                Ok(gst::FlowSuccess::Ok)
+            };
+
+            if let Err(err) = res {
+                gst::debug!(CAT, "Pausing src pad task: {:?}", err);
+                let mut state = self.state.lock().unwrap();
+                // A flush that started meanwhile takes precedence
+                if !state.flushing {
+                    state.flow = Err(err);
+                }
+                drop(state);
+                self.space.notify_all();
+                let _ = self.srcpad.pause_task();
+                return;
+            }
+
+            // Caught up with live while open: let the streaming thread push
+            // directly until something needs queueing again
+            let mut state = self.state.lock().unwrap();
+            if state.pending.is_empty() && state.pacing.take().is_some() {
+                gst::debug!(CAT, "Paced dump caught up with live");
+            }
+            if state.pending.is_empty()
+                && !state.flushing
+                && !state.awaiting_keyframe
+                && !state.leaking
+                && state.rebase.is_none()
+                && state.post_roll.is_none()
+                && state.scheduled_open.is_none()
+                && state.scheduled_close.is_none()
+                && !self.settings.record_while_open.load(Ordering::Relaxed)
+                && self.settings.open.load(Ordering::Relaxed)
+                && self.passthrough.fetch_or(PASSTHROUGH, Ordering::AcqRel) & PASSTHROUGH == 0
+            {
+                gst::debug!(CAT, "Queue drained, switching to pass-through");
             }
         }
 
-        fn sink_event(
+        // Wait on the element clock until the item may go out.
+        // Returns None if a flush started meanwhile.
+        fn wait_paced<'a>(
+            &'a self,
+            mut state: std::sync::MutexGuard<'a, State>,
+            ts: Option<gst::ClockTime>,
+            size: u64,
+        ) -> Option<std::sync::MutexGuard<'a, State>> {
+            let clock = self.obj().clock().unwrap_or_else(gst::SystemClock::obtain);
+            let now = clock.time()?;
+            let settings = self.settings.snapshot();
+            let deadline = state.pacing.as_mut()?.deadline(&settings, now, ts, size);
+            if deadline <= now {
+                return Some(state);
+            }
+
+            let clock_id = clock.new_single_shot_id(deadline);
+            state.clock_wait = Some(clock_id.clone());
+            drop(state);
+            let _ = clock_id.wait();
+
+            let mut state = self.state.lock().unwrap();
+            state.clock_wait = None;
+            if state.flushing {
+                drop(state);
+                let _ = self.srcpad.pause_task();
+                return None;
+            }
+            Some(state)
+        }
+
+        fn start_task(&self) -> Result<(), gst::LoggableError> {
+            {
+                let mut state = self.state.lock().unwrap();
+                state.flushing = false;
+                state.flow = Ok(gst::FlowSuccess::Ok);
+            }
+            self.start_src_loop()
+        }
+
+        fn start_src_loop(&self) -> Result<(), gst::LoggableError> {
+            let element_weak = self.obj().downgrade();
+            self.srcpad
+                .start_task(move || {
+                    if let Some(element) = element_weak.upgrade() {
+                        element.imp().src_loop();
+                    }
+                })
+                .map_err(|err| gst::loggable_error!(CAT, "Failed to start src pad task: {}", err))
+        }
+
+        fn stop_task(&self) -> Result<(), gst::LoggableError> {
+            {
+                let mut state = self.state.lock().unwrap();
+                self.leave_passthrough();
+                state.flushing = true;
+                state.flow = Err(gst::FlowError::Flushing);
+                state.pending.clear();
+                state.leaking = false;
+                state.pacing = None;
+                if let Some(clock_id) = state.clock_wait.take() {
+                    clock_id.unschedule();
+                }
+            }
+            self.cond.notify_one();
+            self.space.notify_all();
+            self.srcpad
+                .stop_task()
+                .map_err(|err| gst::loggable_error!(CAT, "Failed to stop src pad task: {}", err))?;
+
+            // The output shift belongs to the open period of this run; the
+            // next one starts on its own clock
+            {
+                let mut state = self.state.lock().unwrap();
+                state.src_offset = 0;
+                state.rebase = None;
+            }
+            self.srcpad.set_offset(0);
+            Ok(())
+        }
+
+        // Set up the per-element ring file if spilling is configured
+        fn open_spill(&self) {
+            let directory = self.settings.spill_directory.lock().unwrap().clone();
+            let size = self.settings.spill_size.load(Ordering::Relaxed);
+            let directory = match directory {
+                Some(directory) if size > 0 => directory,
+                _ => return,
+            };
+
+            let path = std::path::Path::new(&directory).join(format!(
+                "prerollvalve-{}-{}.ring",
+                std::process::id(),
+                self.obj().name()
+            ));
+            match SpillRing::create(&path, size) {
+                Ok(spill) => {
+                    gst::info!(CAT, "Spilling history older than {} ms to {}",
+                        self.settings.spill_horizon.load(Ordering::Relaxed),
+                        path.display()
+                    );
+                    self.state.lock().unwrap().spill = Some(spill);
+                }
+                Err(err) => {
+                    gst::warning!(CAT, "Failed to create spill file {}: {}", path.display(), err);
+                }
+            }
+        }
+
+        fn src_activatemode(
             &self,
             _pad: &gst::Pad,
-            _element: &super::PrerollValve,
-            event: gst::Event,
-        ) -> bool {
-            // Forward all incoming events (e.g., CAPS/EOS/FLUSH) to src pad to
-            // keep negotiation working.
-            self.srcpad.push_event(event)
+            mode: gst::PadMode,
+            active: bool,
+        ) -> Result<(), gst::LoggableError> {
+            if mode != gst::PadMode::Push {
+                return Err(gst::loggable_error!(CAT, "Only push mode is supported"));
+            }
+
+            if active {
+                self.open_spill();
+                if self.settings.copy_on_store.load(Ordering::Relaxed) {
+                    let size = self.settings.arena_size.load(Ordering::Relaxed);
+                    self.state.lock().unwrap().arena = Some(Arena::new(size));
+                }
+                self.start_task()
+            } else {
+                let res = self.stop_task();
+                // The next activation starts a new stream, with running time
+                // from zero again: nothing recorded, scheduled or tracked for
+                // this one carries over, or its timestamps would never
+                // expire and its data would be dumped into the new stream
+                let mut state = self.state.lock().unwrap();
+                let open_latency = state.open_latency;
+                *state = State {
+                    open_latency,
+                    ..State::default()
+                };
+                self.update_budget(&state);
+                res
+            }
         }
     }
 
@@ -195,6 +2160,13 @@ mod imp {
                         |preroll| preroll.sink_chain(pad, &preroll.obj(), buffer),
                     )
                 })
+                .chain_list_function(|pad, parent, list| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || Err(gst::FlowError::Error),
+                        |preroll| preroll.sink_chain_list(pad, &preroll.obj(), list),
+                    )
+                })
                 .event_function(|pad, parent, event| {
                     PrerollValve::catch_panic_pad_function(
                         parent,
@@ -202,14 +2174,60 @@ mod imp {
                         |preroll| preroll.sink_event(pad, &preroll.obj(), event),
                     )
                 })
+                .query_function(|pad, parent, query| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || false,
+                        |preroll| preroll.sink_query(pad, &preroll.obj(), query),
+                    )
+                })
+                .iterate_internal_links_function(|pad, parent| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || gst::Iterator::from_vec(vec![]),
+                        |preroll| preroll.iterate_internal_links(pad),
+                    )
+                })
                 .build();
 
             let srcpad = gst::Pad::builder_from_template(&templ_src)
+                .activatemode_function(|pad, parent, mode, active| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || Err(gst::loggable_error!(CAT, "Panic activating src pad")),
+                        |preroll| preroll.src_activatemode(pad, mode, active),
+                    )
+                })
+                .event_function(|pad, parent, event| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || false,
+                        |preroll| preroll.src_event(pad, &preroll.obj(), event),
+                    )
+                })
+                .query_function(|pad, parent, query| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || false,
+                        |preroll| preroll.src_query(pad, &preroll.obj(), query),
+                    )
+                })
+                .iterate_internal_links_function(|pad, parent| {
+                    PrerollValve::catch_panic_pad_function(
+                        parent,
+                        || gst::Iterator::from_vec(vec![]),
+                        |preroll| preroll.iterate_internal_links(pad),
+                    )
+                })
                 .build();
 
             Self {
-                settings: Mutex::new(Settings::default()),
+                settings: SharedSettings::default(),
                 state: Mutex::new(State::default()),
+                cond: Condvar::new(),
+                space: Condvar::new(),
+                passthrough: AtomicUsize::new(0),
+                budget: budget::register(),
                 sinkpad,
                 srcpad,
             }
@@ -241,6 +2259,209 @@ mod imp {
                         .mutable_ready()
                         .mutable_playing()
                         .build(),
+                    glib::ParamSpecUInt64::builder("keyframe-history")
+                        .nick("Keyframe History")
+                        .blurb("Total history in milliseconds; beyond max-history only keyframes are kept (0=disabled)")
+                        .default_value(DEFAULT_KEYFRAME_HISTORY)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("max-bytes")
+                        .nick("Max Bytes")
+                        .blurb("Max bytes to buffer (0=unlimited)")
+                        .default_value(DEFAULT_MAX_BYTES)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt::builder("max-buffers")
+                        .nick("Max Buffers")
+                        .blurb("Max number of buffers to buffer (0=unlimited)")
+                        .default_value(DEFAULT_MAX_BUFFERS)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("global-max-bytes")
+                        .nick("Global Max Bytes")
+                        .blurb("Process-wide max bytes buffered by all prerollvalve instances together (0=unlimited)")
+                        .default_value(0)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("global-level-bytes")
+                        .nick("Global level (bytes)")
+                        .blurb("Bytes buffered by all prerollvalve instances in the process")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("current-level-bytes")
+                        .nick("Current level (bytes)")
+                        .blurb("Current amount of data in the history and queued for output (bytes)")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecUInt::builder("current-level-buffers")
+                        .nick("Current level (buffers)")
+                        .blurb("Current number of buffers in the history and queued for output")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("current-level-time")
+                        .nick("Current level (ns)")
+                        .blurb("Current amount of data in the history or queued for output, whichever spans more (in ns)")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecUInt::builder("dump-chunk-size")
+                        .nick("Dump Chunk Size")
+                        .blurb("Max buffers per buffer list pushed during a dump (0=one list per GOP)")
+                        .default_value(DEFAULT_DUMP_CHUNK_SIZE)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("dump-rate")
+                        .nick("Dump Rate")
+                        .blurb("Max bytes per second while a dump catches up with live (0=unlimited)")
+                        .default_value(DEFAULT_DUMP_RATE)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecDouble::builder("dump-speed")
+                        .nick("Dump Speed")
+                        .blurb("Max speed, as a multiple of real time, while a dump catches up with live (0=unlimited)")
+                        .minimum(0.0)
+                        .maximum(1000.0)
+                        .default_value(DEFAULT_DUMP_SPEED)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecString::builder("spill-directory")
+                        .nick("Spill Directory")
+                        .blurb("Directory for the memory-mapped ring file holding history older than spill-horizon (unset=keep everything in RAM)")
+                        .mutable_ready()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("spill-size")
+                        .nick("Spill Size")
+                        .blurb("Size in bytes of the preallocated spill ring file")
+                        .default_value(DEFAULT_SPILL_SIZE)
+                        .mutable_ready()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("spill-horizon")
+                        .nick("Spill Horizon")
+                        .blurb("History in milliseconds kept in RAM when spilling to disk")
+                        .default_value(DEFAULT_SPILL_HORIZON)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecBoolean::builder("copy-on-store")
+                        .nick("Copy On Store")
+                        .blurb("Copy stored payloads into a private arena so upstream buffers are released right away")
+                        .default_value(DEFAULT_COPY_ON_STORE)
+                        .mutable_ready()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("arena-size")
+                        .nick("Arena Size")
+                        .blurb("Bytes preallocated for the copy-on-store arena")
+                        .default_value(DEFAULT_ARENA_SIZE)
+                        .mutable_ready()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("post-roll")
+                        .nick("Post Roll")
+                        .blurb("Close automatically this many milliseconds of stream time after opening, at the next keyframe (0=disabled)")
+                        .default_value(DEFAULT_POST_ROLL)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt::builder("post-roll-gops")
+                        .nick("Post Roll GOPs")
+                        .blurb("Close automatically after this many complete GOPs of live data (0=disabled)")
+                        .default_value(DEFAULT_POST_ROLL_GOPS)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("max-pending-bytes")
+                        .nick("Max Pending Bytes")
+                        .blurb("Max bytes of live data queued for output behind a dump (0=unlimited)")
+                        .default_value(DEFAULT_MAX_PENDING_BYTES)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt::builder("max-pending-buffers")
+                        .nick("Max Pending Buffers")
+                        .blurb("Max buffers of live data queued for output behind a dump (0=unlimited)")
+                        .default_value(DEFAULT_MAX_PENDING_BUFFERS)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("max-pending-time")
+                        .nick("Max Pending Time")
+                        .blurb("Max milliseconds of live data queued for output behind a dump (0=unlimited)")
+                        .default_value(DEFAULT_MAX_PENDING_TIME)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("leaky", DEFAULT_LEAKY)
+                        .nick("Leaky")
+                        .blurb("What to do with live data over the max-pending limits")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("open-at")
+                        .nick("Open At")
+                        .blurb("Running time (ns) at which to open; takes effect on the first buffer at or past it (-1=none)")
+                        .default_value(u64::MAX)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("close-at")
+                        .nick("Close At")
+                        .blurb("Running time (ns) at which to close; takes effect on the first buffer at or past it (-1=none)")
+                        .default_value(u64::MAX)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecBoolean::builder("record-while-open")
+                        .nick("Record While Open")
+                        .blurb("Keep the rolling history while open, so a quick reopen only dumps what was not sent yet (disables the pass-through fast path)")
+                        .default_value(DEFAULT_RECORD_WHILE_OPEN)
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("spill-level-bytes")
+                        .nick("Spill level (bytes)")
+                        .blurb("Current amount of history spilled to disk (bytes)")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecUInt64::builder("open-latency")
+                        .nick("Open Latency")
+                        .blurb("Time between the last open and its first output buffer (in ns)")
+                        .read_only()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("eviction-mode", DEFAULT_EVICTION_MODE)
+                        .nick("Eviction Mode")
+                        .blurb("How buffers older than max-history are evicted")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("output-timestamps", DEFAULT_OUTPUT_TIMESTAMPS)
+                        .nick("Output Timestamps")
+                        .blurb("How dumped (and following live) buffers are timed")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("retention-time", DEFAULT_RETENTION_TIME)
+                        .nick("Retention Time")
+                        .blurb("Time base for max-history and the other time windows")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("keyframe-detection", DEFAULT_KEYFRAME_DETECTION)
+                        .nick("Keyframe Detection")
+                        .blurb("How keyframes are identified")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
+                    glib::ParamSpecEnum::builder_with_default("keyframe-on-open", DEFAULT_KEYFRAME_ON_OPEN)
+                        .nick("Keyframe On Open")
+                        .blurb("What to do when the valve opens without a keyframe to start from")
+                        .mutable_ready()
+                        .mutable_playing()
+                        .build(),
                     glib::ParamSpecBoolean::builder("debug")
                         .nick("Debug")
                         .blurb("Enable extra debug logging")
@@ -254,21 +2475,215 @@ mod imp {
         }
 
         fn set_property(&self, _id: usize, value: &glib::Value, pspec: &glib::ParamSpec) {
-            let mut settings = self.settings.lock().unwrap();
+            let settings = &self.settings;
             match pspec.name() {
-                "open" => settings.open = value.get().expect("type checked upstream"),
-                "max-history" => settings.max_history = value.get().expect("type checked upstream"),
-                "debug" => settings.debug = value.get().expect("type checked upstream"),
+                "open" => {
+                    let open: bool = value.get().expect("type checked upstream");
+                    // Flipped under the state lock so the streaming thread
+                    // never stores into a history that was just dumped
+                    let mut state = self.state.lock().unwrap();
+                    let was_open = settings.open.swap(open, Ordering::Relaxed);
+                    if !open {
+                        self.reset_open_state(&mut state);
+                        return;
+                    }
+                    if was_open {
+                        self.retrigger(&mut state);
+                        return;
+                    }
+
+                    // Start flushing the history right away instead of
+                    // waiting for the next buffer to arrive
+                    let request_keyframe = self.open_valve(&mut state, None);
+                    drop(state);
+                    if request_keyframe {
+                        self.request_keyframe();
+                    }
+                }
+                "open-at" => {
+                    let at: u64 = value.get().expect("type checked upstream");
+                    let mut state = self.state.lock().unwrap();
+                    state.scheduled_open = (at != u64::MAX).then(|| gst::ClockTime::from_nseconds(at));
+                    // Scheduled actions are checked on the locked path
+                    self.leave_passthrough();
+                }
+                "close-at" => {
+                    let at: u64 = value.get().expect("type checked upstream");
+                    let mut state = self.state.lock().unwrap();
+                    state.scheduled_close = (at != u64::MAX).then(|| gst::ClockTime::from_nseconds(at));
+                    self.leave_passthrough();
+                }
+                "max-history" => settings
+                    .max_history
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "global-max-bytes" => budget::set_limit(value.get().expect("type checked upstream")),
+                "keyframe-history" => settings
+                    .keyframe_history
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "max-bytes" => settings
+                    .max_bytes
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "max-buffers" => settings
+                    .max_buffers
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "debug" => settings
+                    .debug
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "eviction-mode" => settings.eviction_mode.store(
+                    value.get::<EvictionMode>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "output-timestamps" => settings.output_timestamps.store(
+                    value.get::<OutputTimestamps>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "retention-time" => settings.retention_time.store(
+                    value.get::<RetentionTime>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "keyframe-detection" => settings.keyframe_detection.store(
+                    value.get::<KeyframeDetection>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "keyframe-on-open" => settings.keyframe_on_open.store(
+                    value.get::<KeyframeOnOpen>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "dump-chunk-size" => settings
+                    .dump_chunk_size
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "dump-rate" => settings
+                    .dump_rate
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "dump-speed" => settings.dump_speed.store(
+                    value.get::<f64>().expect("type checked upstream").to_bits(),
+                    Ordering::Relaxed,
+                ),
+                "spill-directory" => {
+                    *settings.spill_directory.lock().unwrap() =
+                        value.get().expect("type checked upstream")
+                }
+                "spill-size" => settings
+                    .spill_size
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "spill-horizon" => settings
+                    .spill_horizon
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "copy-on-store" => settings
+                    .copy_on_store
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "arena-size" => settings
+                    .arena_size
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "post-roll" => settings
+                    .post_roll
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "post-roll-gops" => settings
+                    .post_roll_gops
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "max-pending-bytes" => settings
+                    .max_pending_bytes
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "max-pending-buffers" => settings
+                    .max_pending_buffers
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "max-pending-time" => settings
+                    .max_pending_time
+                    .store(value.get().expect("type checked upstream"), Ordering::Relaxed),
+                "leaky" => settings.leaky.store(
+                    value.get::<Leaky>().expect("type checked upstream") as u32,
+                    Ordering::Relaxed,
+                ),
+                "record-while-open" => {
+                    let record: bool = value.get().expect("type checked upstream");
+                    let _state = self.state.lock().unwrap();
+                    settings.record_while_open.store(record, Ordering::Relaxed);
+                    // Recording needs the locked path
+                    if record {
+                        self.leave_passthrough();
+                    }
+                }
                 _ => unimplemented!(),
             }
         }
 
         fn property(&self, _id: usize, pspec: &glib::ParamSpec) -> glib::Value {
-            let settings = self.settings.lock().unwrap();
+            let settings = self.settings.snapshot();
             match pspec.name() {
                 "open" => settings.open.to_value(),
                 "max-history" => settings.max_history.to_value(),
+                "keyframe-history" => settings.keyframe_history.to_value(),
+                "max-bytes" => settings.max_bytes.to_value(),
+                "max-buffers" => settings.max_buffers.to_value(),
+                "global-max-bytes" => budget::limit().to_value(),
+                "global-level-bytes" => budget::total().to_value(),
+                "current-level-bytes" => {
+                    let state = self.state.lock().unwrap();
+                    (state.history.bytes() as u64 + state.pending.bytes()).to_value()
+                }
+                "current-level-buffers" => {
+                    let state = self.state.lock().unwrap();
+                    ((state.history.len() + state.history.thinned_len() + state.pending.buffers()) as u32)
+                        .to_value()
+                }
+                "current-level-time" => {
+                    let state = self.state.lock().unwrap();
+                    level_time(&state).max(state.pending.duration()).nseconds().to_value()
+                }
+                "open-latency" => self
+                    .state
+                    .lock()
+                    .unwrap()
+                    .open_latency
+                    .map(|latency| latency.as_nanos() as u64)
+                    .unwrap_or(0)
+                    .to_value(),
                 "debug" => settings.debug.to_value(),
+                "eviction-mode" => settings.eviction_mode.to_value(),
+                "output-timestamps" => settings.output_timestamps.to_value(),
+                "retention-time" => settings.retention_time.to_value(),
+                "keyframe-detection" => settings.keyframe_detection.to_value(),
+                "keyframe-on-open" => settings.keyframe_on_open.to_value(),
+                "dump-chunk-size" => settings.dump_chunk_size.to_value(),
+                "dump-rate" => settings.dump_rate.to_value(),
+                "dump-speed" => settings.dump_speed.to_value(),
+                "spill-directory" => self.settings.spill_directory.lock().unwrap().to_value(),
+                "spill-size" => settings.spill_size.to_value(),
+                "spill-horizon" => settings.spill_horizon.to_value(),
+                "copy-on-store" => settings.copy_on_store.to_value(),
+                "arena-size" => settings.arena_size.to_value(),
+                "record-while-open" => settings.record_while_open.to_value(),
+                "post-roll" => settings.post_roll.to_value(),
+                "open-at" => self
+                    .state
+                    .lock()
+                    .unwrap()
+                    .scheduled_open
+                    .map(|at| at.nseconds())
+                    .unwrap_or(u64::MAX)
+                    .to_value(),
+                "close-at" => self
+                    .state
+                    .lock()
+                    .unwrap()
+                    .scheduled_close
+                    .map(|at| at.nseconds())
+                    .unwrap_or(u64::MAX)
+                    .to_value(),
+                "post-roll-gops" => settings.post_roll_gops.to_value(),
+                "max-pending-bytes" => settings.max_pending_bytes.to_value(),
+                "max-pending-buffers" => settings.max_pending_buffers.to_value(),
+                "max-pending-time" => settings.max_pending_time.to_value(),
+                "leaky" => settings.leaky.to_value(),
+                "spill-level-bytes" => self
+                    .state
+                    .lock()
+                    .unwrap()
+                    .spill
+                    .as_ref()
+                    .map(|spill| spill.bytes() as u64)
+                    .unwrap_or(0)
+                    .to_value(),
                 _ => unimplemented!(),
             }
         }
@@ -0,0 +1,477 @@
+use gstreamer as gst;
+use std::collections::VecDeque;
+use std::fs::{File, OpenOptions};
+use std::io;
+use std::path::Path;
+use std::sync::{Arc, Weak, atomic};
+
+use crate::history::StoredBuffer;
+
+// On-disk record layout, little endian, 8 byte aligned:
+//   pts: u64 (u64::MAX = none)
+//   dts: u64 (u64::MAX = none)
+//   duration: u64 (u64::MAX = none)
+//   flags: u32
+//   size: u32
+//   payload: [u8; size]
+const HEADER_SIZE: usize = 32;
+const RECORD_ALIGN: usize = 8;
+
+struct SpillRecord {
+    // Offset of the record header in the ring file
+    offset: usize,
+    size: usize,
+    // `StoredBuffer::seq` of the buffer, unrelated to the ring's own
+    // sequence numbers
+    history_seq: u64,
+    timestamp: gst::ClockTime,
+    is_keyframe: bool,
+}
+
+// A range of the mapping that was handed out to buffers on dump. The ring
+// never writes over a range while buffers still reference it.
+struct Lease {
+    map: Arc<memmap2::MmapRaw>,
+    start: usize,
+    end: usize,
+}
+
+// Read-only view of one record payload, wrapped as `gst::Memory`
+struct SpillSlice {
+    lease: Arc<Lease>,
+    offset: usize,
+    len: usize,
+}
+
+impl AsRef<[u8]> for SpillSlice {
+    fn as_ref(&self) -> &[u8] {
+        // SAFETY: the range lies inside the mapping, which the lease keeps
+        // alive, and the ring does not write into leased ranges
+        unsafe { std::slice::from_raw_parts(self.lease.map.as_ptr().add(self.offset), self.len) }
+    }
+}
+
+// Ring of buffer records in a preallocated, memory-mapped file. Records are
+// written in stream order and the oldest ones are overwritten when the ring
+// wraps. The file is unlinked right after mapping, so nothing is left behind.
+pub struct SpillRing {
+    map: Arc<memmap2::MmapRaw>,
+    // Where the next record goes
+    tail: usize,
+    records: VecDeque<SpillRecord>,
+    // Sequence numbers of the keyframe records, `head_seq` is the sequence
+    // number of `records.front()`
+    gops: VecDeque<u64>,
+    head_seq: u64,
+    leases: Vec<Weak<Lease>>,
+    bytes: usize,
+}
+
+fn read_u64(data: &[u8], at: usize) -> u64 {
+    u64::from_le_bytes(data[at..at + 8].try_into().unwrap())
+}
+
+fn read_u32(data: &[u8], at: usize) -> u32 {
+    u32::from_le_bytes(data[at..at + 4].try_into().unwrap())
+}
+
+fn clock_time_to_raw(time: Option<gst::ClockTime>) -> u64 {
+    time.map(|time| time.nseconds()).unwrap_or(u64::MAX)
+}
+
+fn raw_to_clock_time(raw: u64) -> Option<gst::ClockTime> {
+    (raw != u64::MAX).then(|| gst::ClockTime::from_nseconds(raw))
+}
+
+// Allocate the blocks of the whole file up front. A sparse file would only
+// fail once the disk fills up, as a SIGBUS on a write through the mapping.
+#[cfg(any(target_os = "linux", target_os = "android", target_os = "freebsd"))]
+fn preallocate(file: &File, size: u64) -> io::Result<()> {
+    use std::os::fd::AsRawFd;
+
+    let len = libc::off_t::try_from(size)
+        .map_err(|_| io::Error::new(io::ErrorKind::InvalidInput, "spill size too large"))?;
+    // SAFETY: plain syscall on a file descriptor we own
+    match unsafe { libc::posix_fallocate(file.as_raw_fd(), 0, len) } {
+        0 => Ok(()),
+        err => Err(io::Error::from_raw_os_error(err)),
+    }
+}
+
+#[cfg(not(any(target_os = "linux", target_os = "android", target_os = "freebsd")))]
+fn preallocate(mut file: &File, size: u64) -> io::Result<()> {
+    use std::io::Write;
+
+    let zeros = vec![0u8; 1 << 20];
+    let mut left = size;
+    while left > 0 {
+        let len = left.min(zeros.len() as u64) as usize;
+        file.write_all(&zeros[..len])?;
+        left -= len as u64;
+    }
+    file.sync_all()
+}
+
+impl SpillRing {
+    pub fn create(path: &Path, size: u64) -> io::Result<Self> {
+        let file = OpenOptions::new()
+            .read(true)
+            .write(true)
+            .create(true)
+            .truncate(true)
+            .open(path)?;
+        if let Err(err) = preallocate(&file, size) {
+            // Don't leave a partially allocated file behind
+            let _ = std::fs::remove_file(path);
+            return Err(err);
+        }
+        let map = memmap2::MmapOptions::new().len(size as usize).map_raw(&file)?;
+        std::fs::remove_file(path)?;
+
+        Ok(Self {
+            map: Arc::new(map),
+            tail: 0,
+            records: VecDeque::new(),
+            gops: VecDeque::new(),
+            head_seq: 0,
+            leases: Vec::new(),
+            bytes: 0,
+        })
+    }
+
+    // Payload bytes currently held on disk
+    pub fn bytes(&self) -> usize {
+        self.bytes
+    }
+
+    pub fn front_timestamp(&self) -> Option<gst::ClockTime> {
+        self.records.front().map(|record| record.timestamp)
+    }
+
+    pub fn front_seq(&self) -> Option<u64> {
+        self.records.front().map(|record| record.history_seq)
+    }
+
+    pub fn second_gop_timestamp(&self) -> Option<gst::ClockTime> {
+        let seq = *self.gops.get(1)?;
+        self.records.get((seq - self.head_seq) as usize).map(|record| record.timestamp)
+    }
+
+    // Append the buffers of one GOP. If the ring cannot take all of them
+    // (too large, or the space is still referenced by dumped buffers) the
+    // whole GOP is dropped and false is returned.
+    pub fn write_gop(&mut self, buffers: impl Iterator<Item = StoredBuffer>) -> bool {
+        // Writing may drop records from the front as the ring wraps, so
+        // track the GOP by sequence number rather than by position
+        let first_seq = self.head_seq + self.records.len() as u64;
+        let mut ok = true;
+        for stored in buffers {
+            if ok && !self.write(&stored) {
+                ok = false;
+            }
+        }
+
+        if !ok {
+            // Roll back the records of this GOP that did make it
+            while !self.records.is_empty()
+                && self.head_seq + self.records.len() as u64 > first_seq
+            {
+                let record = self.records.pop_back().unwrap();
+                self.bytes -= record.size;
+                let seq = self.head_seq + self.records.len() as u64;
+                if self.gops.back() == Some(&seq) {
+                    self.gops.pop_back();
+                }
+                self.tail = record.offset;
+            }
+        }
+        ok
+    }
+
+    fn write(&mut self, stored: &StoredBuffer) -> bool {
+        let map = match stored.buffer.map_readable() {
+            Ok(map) => map,
+            Err(_) => return false,
+        };
+        let size = map.len();
+        let total = (HEADER_SIZE + size).next_multiple_of(RECORD_ALIGN);
+        if total > self.map.len() || size > u32::MAX as usize {
+            return false;
+        }
+
+        let mut offset = self.tail;
+        if offset + total > self.map.len() {
+            // Wrap around. Records between the tail and the end of the file
+            // are the oldest ones; drop them so the records stay laid out in
+            // stream order from the front record on
+            while self.records.front().is_some_and(|front| front.offset >= self.tail) {
+                self.pop_front();
+            }
+            offset = 0;
+        }
+
+        // Dumped buffers may still be reading from here
+        self.leases.retain(|lease| lease.strong_count() > 0);
+        let leased = self.leases.iter().filter_map(Weak::upgrade).any(|lease| {
+            lease.start < offset + total && offset < lease.end
+        });
+        if leased {
+            return false;
+        }
+        // Seeing the last reference to a lease gone is a relaxed load; pair
+        // it with the release of that reference so the reads of the buffers
+        // that held it happen before the overwrite
+        atomic::fence(atomic::Ordering::Acquire);
+
+        // Records are laid out in stream order from the front record on,
+        // so whatever is in the way is the oldest data
+        while let Some(front) = self.records.front() {
+            let front_end = front.offset + HEADER_SIZE + front.size;
+            if front.offset < offset + total && offset < front_end {
+                self.pop_front();
+            } else {
+                break;
+            }
+        }
+
+        let buffer = &stored.buffer;
+        let mut header = [0u8; HEADER_SIZE];
+        header[0..8].copy_from_slice(&clock_time_to_raw(buffer.pts()).to_le_bytes());
+        header[8..16].copy_from_slice(&clock_time_to_raw(buffer.dts()).to_le_bytes());
+        header[16..24].copy_from_slice(&clock_time_to_raw(buffer.duration()).to_le_bytes());
+        header[24..28].copy_from_slice(&buffer.flags().bits().to_le_bytes());
+        header[28..32].copy_from_slice(&(size as u32).to_le_bytes());
+
+        // SAFETY: the target range is inside the mapping, no record is left
+        // in it and no dumped buffer references it
+        unsafe {
+            let dst = self.map.as_mut_ptr().add(offset);
+            std::ptr::copy_nonoverlapping(header.as_ptr(), dst, HEADER_SIZE);
+            std::ptr::copy_nonoverlapping(map.as_ptr(), dst.add(HEADER_SIZE), size);
+        }
+
+        if stored.is_keyframe {
+            self.gops.push_back(self.head_seq + self.records.len() as u64);
+        }
+        self.records.push_back(SpillRecord {
+            offset,
+            size,
+            history_seq: stored.seq,
+            timestamp: stored.timestamp,
+            is_keyframe: stored.is_keyframe,
+        });
+        self.bytes += size;
+        self.tail = offset + total;
+        true
+    }
+
+    fn pop_front(&mut self) -> Option<SpillRecord> {
+        let record = self.records.pop_front()?;
+        if self.gops.front() == Some(&self.head_seq) {
+            self.gops.pop_front();
+        }
+        self.head_seq += 1;
+        self.bytes -= record.size;
+        Some(record)
+    }
+
+    // Drop any leading delta units plus the oldest GOP. With `keep_keyframe`
+    // a heap copy of the GOP's keyframe is returned, for the keyframes-only
+    // tier.
+    pub fn pop_gop(&mut self, keep_keyframe: bool) -> Option<StoredBuffer> {
+        let end = self.gops.get(1).copied().unwrap_or(self.head_seq + self.records.len() as u64);
+        let mut keyframe = None;
+        while self.head_seq < end {
+            let record = self.pop_front().unwrap();
+            if keep_keyframe && record.is_keyframe && keyframe.is_none() {
+                let lease = self.lease(record.offset, record.offset + HEADER_SIZE + record.size);
+                keyframe = self.read(&record, &lease).copy_deep().ok().map(|buffer| StoredBuffer {
+                    buffer,
+                    seq: record.history_seq,
+                    timestamp: record.timestamp,
+                    is_keyframe: true,
+                });
+            }
+        }
+        keyframe
+    }
+
+    fn lease(&self, start: usize, end: usize) -> Arc<Lease> {
+        Arc::new(Lease {
+            map: self.map.clone(),
+            start,
+            end,
+        })
+    }
+
+    // Rebuild the buffer of a record, wrapping its payload zero-copy
+    fn read(&self, record: &SpillRecord, lease: &Arc<Lease>) -> gst::Buffer {
+        // SAFETY: the header lies inside the mapping and was written by us
+        let header = unsafe {
+            std::slice::from_raw_parts(self.map.as_ptr().add(record.offset), HEADER_SIZE)
+        };
+
+        let mut buffer = gst::Buffer::new();
+        {
+            let buffer = buffer.get_mut().unwrap();
+            buffer.set_pts(raw_to_clock_time(read_u64(header, 0)));
+            buffer.set_dts(raw_to_clock_time(read_u64(header, 8)));
+            buffer.set_duration(raw_to_clock_time(read_u64(header, 16)));
+            buffer.set_flags(gst::BufferFlags::from_bits_truncate(read_u32(header, 24)));
+            buffer.append_memory(gst::Memory::from_slice(SpillSlice {
+                lease: lease.clone(),
+                offset: record.offset + HEADER_SIZE,
+                len: read_u32(header, 28) as usize,
+            }));
+        }
+        buffer
+    }
+
+    // Empty the ring, handing out the buffers from the oldest keyframe on.
+    // Payloads stay in the mapping and are wrapped zero-copy; their ranges
+    // are leased until the last buffer is released.
+    pub fn take_all(&mut self) -> Vec<StoredBuffer> {
+        let start = self.gops.front().map(|seq| (seq - self.head_seq) as usize).unwrap_or(0);
+        let records = std::mem::take(&mut self.records);
+        self.head_seq += records.len() as u64;
+        self.gops.clear();
+        self.bytes = 0;
+
+        let mut buffers = Vec::with_capacity(records.len() - start);
+        let mut lease: Option<Arc<Lease>> = None;
+        for record in records.iter().skip(start) {
+            let end = record.offset + HEADER_SIZE + record.size;
+            // One lease per contiguous run; a new one starts where the ring
+            // wrapped around
+            let contiguous = lease.as_ref().is_some_and(|lease| record.offset >= lease.start);
+            if !contiguous {
+                let run_end = records
+                    .iter()
+                    .skip_while(|other| other.offset != record.offset)
+                    .take_while(|other| other.offset >= record.offset)
+                    .last()
+                    .map(|last| last.offset + HEADER_SIZE + last.size)
+                    .unwrap_or(end);
+                let new_lease = self.lease(record.offset, run_end);
+                self.leases.push(Arc::downgrade(&new_lease));
+                lease = Some(new_lease);
+            }
+
+            let buffer = self.read(record, lease.as_ref().unwrap());
+            buffers.push(StoredBuffer {
+                buffer,
+                seq: record.history_seq,
+                timestamp: record.timestamp,
+                is_keyframe: record.is_keyframe,
+            });
+        }
+        buffers
+    }
+
+    pub fn clear(&mut self) {
+        self.head_seq += self.records.len() as u64;
+        self.records.clear();
+        self.gops.clear();
+        self.bytes = 0;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const PAYLOAD: usize = 64;
+    // Room for ten records of `PAYLOAD` bytes, so three GOPs of three
+    const RING_SIZE: u64 = 1024;
+
+    fn ring(name: &str) -> SpillRing {
+        gst::init().unwrap();
+        let path = std::env::temp_dir()
+            .join(format!("prerollvalve-test-{}-{}.ring", std::process::id(), name));
+        SpillRing::create(&path, RING_SIZE).unwrap()
+    }
+
+    // A GOP of `len` buffers starting at `seq`, each filled with its
+    // sequence number
+    fn gop(seq: u64, len: u64, size: usize) -> impl Iterator<Item = StoredBuffer> {
+        (seq..seq + len).map(move |seq| {
+            let mut buffer = gst::Buffer::from_mut_slice(vec![seq as u8; size]);
+            buffer.get_mut().unwrap().set_pts(gst::ClockTime::from_seconds(seq));
+            StoredBuffer {
+                buffer,
+                seq,
+                timestamp: gst::ClockTime::from_seconds(seq),
+                is_keyframe: seq % 3 == 0,
+            }
+        })
+    }
+
+    fn take_seqs(ring: &mut SpillRing) -> Vec<u64> {
+        ring.take_all()
+            .into_iter()
+            .map(|stored| {
+                let map = stored.buffer.map_readable().unwrap();
+                assert!(map.iter().all(|b| *b == stored.seq as u8));
+                assert_eq!(stored.buffer.pts(), Some(gst::ClockTime::from_seconds(stored.seq)));
+                stored.seq
+            })
+            .collect()
+    }
+
+    #[test]
+    fn wraparound_overwrites_the_oldest_gop() {
+        let mut ring = ring("wraparound");
+        for seq in [0, 3, 6] {
+            assert!(ring.write_gop(gop(seq, 3, PAYLOAD)));
+        }
+        assert_eq!(ring.bytes(), 9 * PAYLOAD);
+        assert_eq!(ring.front_seq(), Some(0));
+        assert_eq!(ring.second_gop_timestamp(), Some(gst::ClockTime::from_seconds(3)));
+
+        // The fourth GOP wraps around after its first record and overwrites
+        // the first two records of the oldest GOP
+        assert!(ring.write_gop(gop(9, 3, PAYLOAD)));
+        assert_eq!(ring.front_seq(), Some(2));
+        assert_eq!(ring.front_timestamp(), Some(gst::ClockTime::from_seconds(2)));
+        assert_eq!(ring.bytes(), 10 * PAYLOAD);
+
+        // The leftover delta unit is skipped, the rest reads back in order
+        assert_eq!(take_seqs(&mut ring), (3..12).collect::<Vec<_>>());
+        assert_eq!(ring.bytes(), 0);
+        assert_eq!(ring.front_seq(), None);
+    }
+
+    #[test]
+    fn pop_gop_moves_past_the_oldest_keyframe() {
+        let mut ring = ring("pop-gop");
+        for seq in [0, 3] {
+            assert!(ring.write_gop(gop(seq, 3, PAYLOAD)));
+        }
+        let keyframe = ring.pop_gop(true).unwrap();
+        assert_eq!(keyframe.seq, 0);
+        assert!(keyframe.is_keyframe);
+        assert_eq!(ring.front_seq(), Some(3));
+        assert_eq!(ring.bytes(), 3 * PAYLOAD);
+        assert!(ring.pop_gop(false).is_none());
+        assert_eq!(ring.front_seq(), None);
+    }
+
+    #[test]
+    fn failed_gop_is_rolled_back() {
+        let mut ring = ring("rollback");
+        for seq in [0, 3, 6] {
+            assert!(ring.write_gop(gop(seq, 3, PAYLOAD)));
+        }
+
+        // The keyframe fits at the end of the file, the first delta unit
+        // wraps around and overwrites the oldest record, the last one is
+        // larger than the ring. Only the new records go away.
+        let failed = gop(9, 2, PAYLOAD).chain(gop(11, 1, RING_SIZE as usize));
+        assert!(!ring.write_gop(failed));
+        assert_eq!(ring.front_seq(), Some(1));
+        assert_eq!(ring.bytes(), 8 * PAYLOAD);
+
+        assert!(ring.write_gop(gop(12, 3, PAYLOAD)));
+        assert_eq!(take_seqs(&mut ring), [3, 4, 5, 6, 7, 8, 12, 13, 14]);
+    }
+}
@@ -11,6 +11,26 @@ Scenario:
     - open at   +60s
     - close at  +80s (remains closed through the end)
 - Output is split with splitmuxsink into 5s segments for inspection.
+
+With --bframes N the encoder emits B-frames (PTS not monotonic in decode
+order). The run then also reports the peak history level, which must stay
+within max-history plus one GOP, and checks that output DTS never goes
+backwards.
+
+With --bench-passthrough it instead compares the throughput of an open
+valve (pass-through fast path) with identity on a fakesrc ! fakesink
+pipeline. With --bench-contention it toggles `open` from several threads
+while buffers flow, checking that neither side stalls. With --bench-copies
+it checks that dumped buffers reach downstream unshared, so they can be
+modified in place without a deep copy.
+
+The --check-* options run short functional checks on encoded video instead:
+--check-gop-eviction checks that a GOP-evicted history dumps whole GOPs
+starting on a keyframe. --check-limits checks that max-buffers and max-bytes
+bound the history regardless of max-history. --check-post-roll checks that
+post-roll-gops closes the valve in front of a keyframe, restarting on a
+retrigger. --check-schedule checks that open-at and close-at act at their
+running times, with the dump covering max-history before the open.
 """
 from __future__ import annotations
 
@@ -19,7 +39,9 @@ import glob
 import os
 import sys
 import tempfile
-from typing import List, Tuple
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
 
 import gi
 
@@ -35,6 +57,28 @@ PREROLL_SECONDS = 8.0
 MAX_HISTORY_MS = int(PREROLL_SECONDS * 1000)
 SPLIT_DURATION_SECONDS = 5
 SPLIT_DURATION_NS = SPLIT_DURATION_SECONDS * 1_000_000_000
+KEY_INT_MAX = 60
+LEVEL_POLL_MS = 100
+
+# Benchmarks
+BENCH_BUFFERS = 200_000
+BENCH_BUFFER_SIZE = 4096
+BENCH_RUNS = 5
+# An open valve must reach this fraction of identity's throughput
+PASSTHROUGH_MIN_RATIO = 0.95
+CONTENTION_BUFFERS = 100_000
+CONTENTION_THREADS = 4
+# Buffers/s that must keep flowing while the valve is toggled
+CONTENTION_MIN_RATE = 1000
+COPIES_STORED = 200
+# A run taking longer than this is considered deadlocked
+BENCH_TIMEOUT_S = 120
+
+# Functional checks: 10s of 1s GOPs, encoded as fast as possible
+CHECK_BUFFERS = 300
+CHECK_GOP = 30
+CHECK_FRAME_NS = 1_000_000_000 // FRAMERATE
+CHECK_OPEN_AT_BUFFER = 200
 
 # Valve schedule (absolute times from start, seconds)
 VALVE_SCHEDULE: List[Tuple[str, float]] = [
@@ -56,19 +100,27 @@ def schedule_valve_transitions(valve: Gst.Element):
         GLib.timeout_add(int(at_seconds * 1000), _toggle)
 
 
-def run_pipeline(output_dir: str) -> tuple[int, list[str]]:
-    """Run the pipeline once and return (buffer_count, segment_paths)."""
+def run_pipeline(output_dir: str, bframes: int = 0) -> tuple[int, list[str], dict]:
+    """Run the pipeline once and return (buffer_count, segment_paths, stats)."""
     Gst.init(None)
 
     buffer_count = [0]
+    stats = {"peak_level_ns": 0, "peak_level_bytes": 0, "dts_backwards": 0}
+    last_dts = [Gst.CLOCK_TIME_NONE]
     output_pattern = os.path.join(output_dir, "segment-%02d.mkv")
 
+    # zerolatency disables B-frames, so only use it without them
+    if bframes > 0:
+        encoder = f"x264enc bframes={bframes} b-adapt=false "
+    else:
+        encoder = "x264enc tune=zerolatency "
+
     # Pipeline: videotestsrc -> encoder -> prerollvalve -> counter -> splitmuxsink
     pipeline_desc = (
         f"videotestsrc num-buffers={NUM_BUFFERS} is-live=true "
         f"! video/x-raw,width=640,height=360,framerate={FRAMERATE}/1 "
         "! queue "
-        "! x264enc tune=zerolatency bitrate=512 speed-preset=ultrafast key-int-max=60 "
+        f"! {encoder}bitrate=512 speed-preset=ultrafast key-int-max={KEY_INT_MAX} "
         "! h264parse "
         f"! prerollvalve name=valve open=false max-history={MAX_HISTORY_MS} debug=true "
         "! identity name=counter silent=true signal-handoffs=true "
@@ -87,8 +139,13 @@ def run_pipeline(output_dir: str) -> tuple[int, list[str]]:
         print("Failed to retrieve prerollvalve or counter element.", file=sys.stderr)
         sys.exit(1)
 
-    def on_handoff(_identity, _buffer):
+    def on_handoff(_identity, buffer):
         buffer_count[0] += 1
+        dts = buffer.dts
+        if dts != Gst.CLOCK_TIME_NONE:
+            if last_dts[0] != Gst.CLOCK_TIME_NONE and dts < last_dts[0]:
+                stats["dts_backwards"] += 1
+            last_dts[0] = dts
 
     counter.connect("handoff", on_handoff)
 
@@ -111,6 +168,15 @@ def run_pipeline(output_dir: str) -> tuple[int, list[str]]:
 
     schedule_valve_transitions(valve)
 
+    def poll_level():
+        stats["peak_level_ns"] = max(stats["peak_level_ns"], valve.get_property("current-level-time"))
+        stats["peak_level_bytes"] = max(
+            stats["peak_level_bytes"], valve.get_property("current-level-bytes")
+        )
+        return True
+
+    GLib.timeout_add(LEVEL_POLL_MS, poll_level)
+
     print("Starting pipeline...")
     pipeline.set_state(Gst.State.PLAYING)
 
@@ -121,10 +187,339 @@ def run_pipeline(output_dir: str) -> tuple[int, list[str]]:
         bus.remove_signal_watch()
 
     if error_occurred[0]:
-        return -1, []
+        return -1, [], stats
 
     segments = sorted(glob.glob(os.path.join(output_dir, "segment-*.mkv")))
-    return buffer_count[0], segments
+    return buffer_count[0], segments, stats
+
+
+def time_until_eos(
+    pipeline_desc: str, setup: Optional[Callable[[Gst.Pipeline], None]] = None
+) -> float:
+    """Run a pipeline to EOS and return the wall time it took, in seconds."""
+    pipeline = Gst.parse_launch(pipeline_desc)
+    if setup is not None:
+        setup(pipeline)
+    bus = pipeline.get_bus()
+
+    start = time.perf_counter()
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        message = bus.timed_pop_filtered(
+            BENCH_TIMEOUT_S * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+    if message is None:
+        raise RuntimeError(f"No EOS after {BENCH_TIMEOUT_S}s, deadlocked?")
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise RuntimeError(f"{err} ({debug})")
+    return elapsed
+
+
+def bench_throughput(element: str, runs: int = BENCH_RUNS) -> float:
+    """Best buffers/s of `element` between fakesrc and fakesink over a few runs."""
+    pipeline_desc = (
+        f"fakesrc num-buffers={BENCH_BUFFERS} sizetype=fixed sizemax={BENCH_BUFFER_SIZE} "
+        f"filltype=zero ! {element} ! fakesink sync=false"
+    )
+    best = min(time_until_eos(pipeline_desc) for _ in range(runs))
+    return BENCH_BUFFERS / best
+
+
+def bench_passthrough() -> bool:
+    """Compare an open valve with identity; True if it keeps up."""
+    print(f"Pass-through throughput, {BENCH_BUFFERS} x {BENCH_BUFFER_SIZE} byte buffers, "
+          f"best of {BENCH_RUNS}:")
+    identity = bench_throughput("identity")
+    valve = bench_throughput("prerollvalve open=true")
+    ratio = valve / identity
+    ok = ratio >= PASSTHROUGH_MIN_RATIO
+    print(f"  identity:          {identity:>12,.0f} buffers/s")
+    print(f"  prerollvalve open: {valve:>12,.0f} buffers/s")
+    print(f"  ratio: {ratio:.2f} (minimum {PASSTHROUGH_MIN_RATIO}, {'ok' if ok else 'FAIL'})")
+    return ok
+
+
+def bench_contention() -> bool:
+    """Toggle the valve from several threads while buffers flow; True if it keeps up."""
+    stop = threading.Event()
+    toggles = [0] * CONTENTION_THREADS
+    threads: List[threading.Thread] = []
+
+    def toggle(valve: Gst.Element, index: int):
+        is_open = index % 2 == 0
+        while not stop.is_set():
+            is_open = not is_open
+            valve.set_property("open", is_open)
+            valve.get_property("current-level-bytes")
+            toggles[index] += 1
+
+    def start_threads(pipeline: Gst.Pipeline):
+        valve = pipeline.get_by_name("valve")
+        for index in range(CONTENTION_THREADS):
+            thread = threading.Thread(target=toggle, args=(valve, index), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    # Untimestamped buffers never expire, so bound the history by count
+    pipeline_desc = (
+        f"fakesrc num-buffers={CONTENTION_BUFFERS} sizetype=fixed sizemax={BENCH_BUFFER_SIZE} "
+        "filltype=zero ! prerollvalve name=valve max-buffers=1000 ! fakesink sync=false"
+    )
+    print(f"Contention: {CONTENTION_THREADS} threads toggling open while "
+          f"{CONTENTION_BUFFERS} buffers flow:")
+    try:
+        elapsed = time_until_eos(pipeline_desc, start_threads)
+    except RuntimeError as err:
+        print(f"  FAIL: {err}")
+        return False
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+    rate = CONTENTION_BUFFERS / elapsed
+    ok = rate >= CONTENTION_MIN_RATE and not any(thread.is_alive() for thread in threads)
+    print(f"  {rate:,.0f} buffers/s (minimum {CONTENTION_MIN_RATE}), "
+          f"{sum(toggles) / elapsed:,.0f} toggles/s ({'ok' if ok else 'FAIL'})")
+    return ok
+
+
+def count_shared_dumped(record_while_open: bool) -> tuple[int, int]:
+    """Open the valve on a stored history and return (dumped, shared) buffer counts.
+
+    A dumped buffer still referenced elsewhere (e.g. by the history) is not
+    writable downstream, so the first make_writable() on it deep-copies it.
+    """
+    # Reference count of an unshared buffer in a list, as seen from Python
+    # (the wrapper holds a reference of its own)
+    calibration = Gst.BufferList.new()
+    calibration.add(Gst.Buffer.new())
+    unshared = calibration.get(0).mini_object.refcount
+
+    counts = {"stored": 0, "dumped": 0, "shared": 0}
+
+    def on_sink_buffer(_pad, _info, valve):
+        counts["stored"] += 1
+        if counts["stored"] == COPIES_STORED:
+            valve.set_property("open", True)
+        return Gst.PadProbeReturn.OK
+
+    def on_src_list(_pad, info):
+        buffers = info.get_buffer_list()
+        for index in range(buffers.length()):
+            counts["dumped"] += 1
+            if buffers.get(index).mini_object.refcount > unshared:
+                counts["shared"] += 1
+        return Gst.PadProbeReturn.OK
+
+    def add_probes(pipeline: Gst.Pipeline):
+        valve = pipeline.get_by_name("valve")
+        valve.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, on_sink_buffer, valve)
+        valve.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER_LIST, on_src_list)
+
+    pipeline_desc = (
+        f"fakesrc num-buffers={COPIES_STORED * 2} sizetype=fixed sizemax={BENCH_BUFFER_SIZE} "
+        f"filltype=zero ! prerollvalve name=valve max-buffers={COPIES_STORED * 2} "
+        f"record-while-open={str(record_while_open).lower()} ! fakesink sync=false"
+    )
+    time_until_eos(pipeline_desc, add_probes)
+    return counts["dumped"], counts["shared"]
+
+
+def bench_copies() -> bool:
+    """Check that dumped buffers are moved out of the history, not shared."""
+    print(f"Dump copies, {COPIES_STORED} stored buffers:")
+    dumped, shared = count_shared_dumped(record_while_open=False)
+    moved_ok = dumped > 0 and shared == 0
+    print(f"  history released: {shared} of {dumped} dumped buffers shared, "
+          f"{shared} deep copies downstream ({'ok' if moved_ok else 'FAIL'})")
+
+    # With record-while-open the history keeps its references, which the
+    # probe must be able to tell
+    kept_dumped, kept_shared = count_shared_dumped(record_while_open=True)
+    kept_ok = kept_dumped > 0 and kept_shared == kept_dumped
+    print(f"  history kept:     {kept_shared} of {kept_dumped} dumped buffers shared "
+          f"({'ok' if kept_ok else 'FAIL'})")
+    return moved_ok and kept_ok
+
+
+def is_keyframe(buffer: Gst.Buffer) -> bool:
+    return not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT)
+
+
+def capture_valve_output(
+    valve_props: str, open_at_buffer: Optional[int] = None, reopen_at_buffer: Optional[int] = None
+) -> dict:
+    """Run encoded video through a closed valve and record what goes in and out.
+
+    `open` is set in front of input buffers `open_at_buffer` and
+    `reopen_at_buffer`, if given.
+    Input, dumped (buffer lists) and live (single buffers) output are lists
+    of (pts, is_keyframe). Also returns the peak `current-level-buffers` and
+    `current-level-bytes` seen while closed and the last `open` state.
+    """
+    result = {"input": [], "dumped": [], "live": [], "peak_buffers": 0, "peak_bytes": 0}
+
+    def on_sink_buffer(_pad, info, valve):
+        buffer = info.get_buffer()
+        if len(result["input"]) in (open_at_buffer, reopen_at_buffer):
+            valve.set_property("open", True)
+        result["input"].append((buffer.pts, is_keyframe(buffer)))
+        if not valve.get_property("open"):
+            result["peak_buffers"] = max(
+                result["peak_buffers"], valve.get_property("current-level-buffers")
+            )
+            result["peak_bytes"] = max(result["peak_bytes"], valve.get_property("current-level-bytes"))
+        return Gst.PadProbeReturn.OK
+
+    def on_src_buffer(_pad, info):
+        buffer = info.get_buffer()
+        result["live"].append((buffer.pts, is_keyframe(buffer)))
+        return Gst.PadProbeReturn.OK
+
+    def on_src_list(_pad, info):
+        buffers = info.get_buffer_list()
+        for index in range(buffers.length()):
+            buffer = buffers.get(index)
+            result["dumped"].append((buffer.pts, is_keyframe(buffer)))
+        return Gst.PadProbeReturn.OK
+
+    def on_notify_open(valve, _pspec):
+        result["open"] = valve.get_property("open")
+
+    def add_probes(pipeline: Gst.Pipeline):
+        valve = pipeline.get_by_name("valve")
+        result["open"] = valve.get_property("open")
+        valve.connect("notify::open", on_notify_open)
+        valve.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, on_sink_buffer, valve)
+        src = valve.get_static_pad("src")
+        src.add_probe(Gst.PadProbeType.BUFFER, on_src_buffer)
+        src.add_probe(Gst.PadProbeType.BUFFER_LIST, on_src_list)
+
+    pipeline_desc = (
+        f"videotestsrc num-buffers={CHECK_BUFFERS} "
+        f"! video/x-raw,width=320,height=240,framerate={FRAMERATE}/1 "
+        f"! x264enc tune=zerolatency speed-preset=ultrafast key-int-max={CHECK_GOP} "
+        f"! h264parse ! prerollvalve name=valve {valve_props} ! fakesink sync=false"
+    )
+    time_until_eos(pipeline_desc, add_probes)
+    return result
+
+
+def dump_is_contiguous(result: dict, open_at_buffer: int) -> bool:
+    """True if the dump is the input right in front of the open, without gaps."""
+    dumped = result["dumped"]
+    return bool(dumped) and result["input"][open_at_buffer - len(dumped):open_at_buffer] == dumped
+
+
+def check_gop_eviction() -> bool:
+    """Dump a GOP-evicted history; True if it holds whole GOPs covering the window."""
+    window_ms = 1500
+    print(f"GOP eviction, max-history={window_ms}ms with {CHECK_GOP}-frame GOPs:")
+    result = capture_valve_output(
+        f"max-history={window_ms} eviction-mode=gop", CHECK_OPEN_AT_BUFFER
+    )
+    dumped = result["dumped"]
+    contiguous = dump_is_contiguous(result, CHECK_OPEN_AT_BUFFER)
+    starts_on_keyframe = bool(dumped) and dumped[0][1]
+    # The window, plus at most the rest of the oldest GOP
+    span = result["input"][CHECK_OPEN_AT_BUFFER - 1][0] - dumped[0][0] if dumped else 0
+    window_ns = window_ms * 1_000_000
+    span_ok = window_ns - CHECK_FRAME_NS <= span <= window_ns + CHECK_GOP * CHECK_FRAME_NS
+    ok = contiguous and starts_on_keyframe and span_ok
+    print(f"  dumped {len(dumped)} buffers spanning {span / 1e9:.2f}s, "
+          f"contiguous: {contiguous}, starts on keyframe: {starts_on_keyframe} "
+          f"({'ok' if ok else 'FAIL'})")
+    return ok
+
+
+def check_limits() -> bool:
+    """Store more than max-buffers/max-bytes allow; True if the levels stay bounded."""
+    # Half a GOP over one GOP, far less than max-history holds
+    max_buffers = CHECK_GOP * 3 // 2
+    props = "max-history=60000"
+    print(f"Limits, max-history=60000ms with {CHECK_GOP}-frame GOPs:")
+
+    by_count = capture_valve_output(f"{props} max-buffers={max_buffers}", CHECK_OPEN_AT_BUFFER)
+    count_ok = (
+        0 < by_count["peak_buffers"] <= max_buffers
+        and 0 < len(by_count["dumped"]) <= max_buffers
+        and by_count["dumped"][0][1]
+        and dump_is_contiguous(by_count, CHECK_OPEN_AT_BUFFER)
+    )
+    print(f"  max-buffers={max_buffers}: peak {by_count['peak_buffers']} buffers, "
+          f"dumped {len(by_count['dumped'])} ({'ok' if count_ok else 'FAIL'})")
+
+    # The bytes the count limit let through hold more than one GOP
+    max_bytes = by_count["peak_bytes"]
+    by_size = capture_valve_output(f"{props} max-bytes={max_bytes}", CHECK_OPEN_AT_BUFFER)
+    size_ok = (
+        0 < by_size["peak_bytes"] <= max_bytes
+        and bool(by_size["dumped"])
+        and by_size["dumped"][0][1]
+        and dump_is_contiguous(by_size, CHECK_OPEN_AT_BUFFER)
+    )
+    print(f"  max-bytes={max_bytes}: peak {by_size['peak_bytes']} bytes, "
+          f"dumped {len(by_size['dumped'])} buffers ({'ok' if size_ok else 'FAIL'})")
+    return count_ok and size_ok
+
+
+def check_post_roll() -> bool:
+    """Open mid-GOP and retrigger; True if post-roll closes after whole GOPs."""
+    gops = 2
+    open_at = CHECK_GOP * 3 + CHECK_GOP // 3
+    reopen_at = open_at + CHECK_GOP
+    print(f"Post-roll, post-roll-gops={gops}, open at buffer {open_at}, retrigger at {reopen_at}:")
+    result = capture_valve_output(f"max-history=2000 post-roll-gops={gops}", open_at, reopen_at)
+
+    inputs, live = result["input"], result["live"]
+    end = open_at + len(live)
+    # Live output runs from the open up to the keyframe after the last
+    # complete GOP following the retrigger
+    contiguous = bool(live) and inputs[open_at:end] == live
+    ends_on_gop = end < len(inputs) and inputs[end][1]
+    gops_after_retrigger = sum(1 for _, keyframe in inputs[reopen_at:end] if keyframe)
+    ok = contiguous and ends_on_gop and gops_after_retrigger == gops and not result["open"]
+    print(f"  {len(live)} live buffers, contiguous: {contiguous}, closed in front of a "
+          f"keyframe: {ends_on_gop}, {gops_after_retrigger} GOPs after the retrigger, "
+          f"open at the end: {result['open']} ({'ok' if ok else 'FAIL'})")
+    return ok
+
+
+def check_schedule() -> bool:
+    """Schedule an open and a close; True if both act at their running times."""
+    window_ms = 2000
+    open_ns, close_ns = 5 * Gst.SECOND, 8 * Gst.SECOND
+    print(f"Schedule, open-at={open_ns / 1e9:.0f}s close-at={close_ns / 1e9:.0f}s, "
+          f"max-history={window_ms}ms:")
+    result = capture_valve_output(
+        f"max-history={window_ms} open-at={open_ns} close-at={close_ns}"
+    )
+
+    inputs, dumped, live = result["input"], result["dumped"], result["live"]
+    # Each action fires in front of the first buffer at or past its time;
+    # the segment starts at 0, so running time is the PTS
+    opened = next(index for index, (pts, _) in enumerate(inputs) if pts >= open_ns)
+    closed = next(index for index, (pts, _) in enumerate(inputs) if pts >= close_ns)
+    # The dump starts at the keyframe covering the window before the open
+    window_start = open_ns - window_ms * 1_000_000
+    dump_ok = (
+        dump_is_contiguous(result, opened)
+        and dumped[0][1]
+        and window_start - CHECK_GOP * CHECK_FRAME_NS < dumped[0][0] <= window_start
+    )
+    live_ok = inputs[opened:closed] == live
+    ok = dump_ok and live_ok and not result["open"]
+    first = dumped[0][0] / 1e9 if dumped else float("nan")
+    print(f"  dumped {len(dumped)} buffers from {first:.2f}s ({'ok' if dump_ok else 'FAIL'}), "
+          f"{len(live)} live buffers up to the close ({'ok' if live_ok else 'FAIL'}), "
+          f"open at the end: {result['open']}")
+    return ok
 
 
 def resolve_output_dir(arg_dir: str | None) -> str:
@@ -161,6 +556,47 @@ def parse_args() -> argparse.Namespace:
         "--output-dir",
         help="Directory for splitmux output (defaults to OUTPUT_DIR env, then /output, then temp)",
     )
+    parser.add_argument(
+        "--bframes",
+        type=int,
+        default=0,
+        help="Number of B-frames for x264enc (default 0); checks memory bounds and DTS order",
+    )
+    parser.add_argument(
+        "--bench-passthrough",
+        action="store_true",
+        help="Compare open-valve throughput with identity instead of running the scenario",
+    )
+    parser.add_argument(
+        "--bench-copies",
+        action="store_true",
+        help="Check that dumped buffers reach downstream unshared instead of running the scenario",
+    )
+    parser.add_argument(
+        "--bench-contention",
+        action="store_true",
+        help="Toggle open from several threads while buffers flow instead of running the scenario",
+    )
+    parser.add_argument(
+        "--check-gop-eviction",
+        action="store_true",
+        help="Check that eviction-mode=gop dumps whole GOPs instead of running the scenario",
+    )
+    parser.add_argument(
+        "--check-limits",
+        action="store_true",
+        help="Check that max-buffers and max-bytes bound the history instead of running the scenario",
+    )
+    parser.add_argument(
+        "--check-post-roll",
+        action="store_true",
+        help="Check that post-roll closes on a GOP boundary instead of running the scenario",
+    )
+    parser.add_argument(
+        "--check-schedule",
+        action="store_true",
+        help="Check that open-at and close-at act on time instead of running the scenario",
+    )
     return parser.parse_args()
 
 
@@ -176,6 +612,27 @@ def main():
         print("ERROR: prerollvalve element not found. Check GST_PLUGIN_PATH.", file=sys.stderr)
         sys.exit(1)
 
+    checks = (args.bench_passthrough, args.bench_contention, args.bench_copies,
+              args.check_gop_eviction, args.check_limits, args.check_post_roll,
+              args.check_schedule)
+    if any(checks):
+        ok = True
+        if args.bench_passthrough:
+            ok = bench_passthrough() and ok
+        if args.bench_contention:
+            ok = bench_contention() and ok
+        if args.bench_copies:
+            ok = bench_copies() and ok
+        if args.check_gop_eviction:
+            ok = check_gop_eviction() and ok
+        if args.check_limits:
+            ok = check_limits() and ok
+        if args.check_post_roll:
+            ok = check_post_roll() and ok
+        if args.check_schedule:
+            ok = check_schedule() and ok
+        sys.exit(0 if ok else 1)
+
     output_dir = resolve_output_dir(args.output_dir)
 
     print("=" * 60)
@@ -187,10 +644,11 @@ def main():
     for action, at_s in VALVE_SCHEDULE:
         print(f"  - {action.upper():<5} at +{at_s:>4.1f}s")
     print(f"Splitmux chunks: {SPLIT_DURATION_SECONDS}s each")
+    print(f"B-frames:        {args.bframes}")
     print(f"Output directory: {output_dir}")
     print()
 
-    buffer_count, segments = run_pipeline(output_dir)
+    buffer_count, segments, stats = run_pipeline(output_dir, args.bframes)
 
     print()
     print("=" * 60)
@@ -206,8 +664,18 @@ def main():
     else:
         print("No segments were produced.")
 
+    # The window may exceed max-history by at most one GOP
+    level_bound_ns = (PREROLL_SECONDS + KEY_INT_MAX / FRAMERATE) * 1_000_000_000
+    level_ok = stats["peak_level_ns"] <= level_bound_ns
+    order_ok = stats["dts_backwards"] == 0
+    print(
+        f"Peak history level: {stats['peak_level_ns'] / 1e9:.2f}s, "
+        f"{stats['peak_level_bytes']} bytes ({'ok' if level_ok else 'OVER BOUND'})"
+    )
+    print(f"Output DTS going backwards: {stats['dts_backwards']} ({'ok' if order_ok else 'FAIL'})")
+
     # Non-zero exit code signals failure
-    sys.exit(0 if buffer_count > 0 and segments else 1)
+    sys.exit(0 if buffer_count > 0 and segments and level_ok and order_ok else 1)
 
 
 if __name__ == "__main__":